@@ -1,26 +1,39 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
 import uvicorn
 import os
+import json
 from pathlib import Path
 from utils.math_processor import MathProcessor
 from utils.symbolic_processor import SymbolicProcessor
-from utils.rag_pipeline import RagPipeline
+from utils import model_registry
 from utils import rag
+from utils.latex_ngram_index import PatternTooShortError
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up at server start rather than import, so PDF extraction workers
+    # (spawned processes re-import this module) do not load the models too
+    rag_pipeline.warm_up(background=True)
+    yield
+    rag_pipeline.close()
 
 app = FastAPI(
     title="Math-Enhanced Local RAG API",
     description="API for mathematical question answering using RAG",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Initialize processors and pipeline
 math_processor = MathProcessor()
 symbolic_processor = SymbolicProcessor()
-rag_pipeline = RagPipeline(math_processor, symbolic_processor)
-# Set storage directory to indexes
-rag_pipeline.storage_dir = "indexes"
+# Shared with rag.rag_pipeline() so uploads reuse the loaded models and index
+# Lazy so the server answers immediately; models load in the background or on first use
+rag_pipeline = model_registry.get_pipeline("indexes", math_processor, symbolic_processor, lazy=True)
 
 # Create necessary directories
 os.makedirs("pdfs", exist_ok=True)
@@ -29,29 +42,145 @@ os.makedirs("indexes", exist_ok=True)
 class Query(BaseModel):
     question: str
     top_k: Optional[int] = 3
+    # IVF lists scanned per query on large indexes: higher is more accurate, lower is faster (0 = exact)
+    nprobe: Optional[int] = None
+    # Only retrieve math documents using all of these LaTeX commands, e.g. ["\\oint", "\\nabla"]
+    symbols: Optional[List[str]] = None
+    # "vector" (dense only) or "hybrid" (dense + BM25 with reciprocal rank fusion)
+    mode: Literal["vector", "hybrid"] = "vector"
+    # Long questions: "concurrent" (one LLM call per chunk) or "merge" (one call over all chunks' context)
+    chunk_mode: Literal["concurrent", "merge"] = "concurrent"
 
 class MathAnalysis(BaseModel):
     latex: str
 
+class FormulaLookup(BaseModel):
+    latex: str
+    alpha_equivalent: Optional[bool] = True
+    limit: Optional[int] = 20
+
+class FormulaSearch(BaseModel):
+    pattern: str
+    limit: Optional[int] = 20
+    # Fraction of the pattern's token n-grams a formula must share; 1.0 also requires the full sub-expression
+    min_match: Optional[float] = 1.0
+
+class SymbolLookup(BaseModel):
+    symbols: List[str]
+    match_all: Optional[bool] = True
+    limit: Optional[int] = 20
+
+@app.get("/health")
+async def health():
+    """
+    Report liveness and which pipeline components have been loaded
+    """
+    return {"status": "ok", **rag_pipeline.status()}
+
 @app.post("/query")
 async def query_endpoint(query: Query):
     """
     Process a mathematical query and return the answer with sources
     """
     try:
-        response = rag_pipeline.query(
+        # Awaited: retrieval runs in worker threads and the LLM call is async, so other requests keep being served
+        response = await rag_pipeline.aquery(
             question=query.question,
-            top_k=query.top_k
+            top_k=query.top_k,
+            nprobe=query.nprobe,
+            symbols=query.symbols,
+            mode=query.mode,
+            chunk_mode=query.chunk_mode
         )
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream")
+def query_stream_endpoint(query: Query, request: Request):
+    """
+    Stream the answer as NDJSON events (Server-Sent Events with Accept: text/event-stream):
+    the sources right after retrieval, then tokens as the LLM generates them
+    """
+    # A plain def runs in the threadpool, so retrieval and generation never block the event loop
+    try:
+        events = rag_pipeline.query_stream(
+            question=query.question,
+            top_k=query.top_k,
+            nprobe=query.nprobe,
+            symbols=query.symbols,
+            mode=query.mode
+        )
+        # Fail with a status code while it is still possible, before the stream starts
+        first = next(events)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    def encode(event):
+        line = json.dumps(event, default=str)
+        return f"data: {line}\n\n" if sse else line + "\n"
+    
+    def body():
+        yield encode(first)
+        try:
+            for event in events:
+                yield encode(event)
+        except Exception as e:
+            yield encode({"type": "error", "detail": str(e)})
+    
+    return StreamingResponse(body(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+@app.post("/symbols")
+def symbols_endpoint(lookup: SymbolLookup):
+    """
+    Find indexed formulas by the LaTeX commands they use (no embedding or LLM call)
+    """
+    try:
+        return rag_pipeline.find_symbols(
+            lookup.symbols,
+            match_all=lookup.match_all,
+            limit=lookup.limit
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/formulas")
+def formulas_endpoint(lookup: FormulaLookup):
+    """
+    Find where a formula is stated, exactly or up to variable renaming (no embedding or LLM call)
+    """
+    try:
+        return rag_pipeline.find_formula(
+            lookup.latex,
+            alpha_equivalent=lookup.alpha_equivalent,
+            limit=lookup.limit
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/formulas/search")
+def formula_search_endpoint(search: FormulaSearch):
+    """
+    Find formulas containing a LaTeX sub-expression, e.g. \\frac{\\partial ...}{\\partial t}
+    """
+    try:
+        return rag_pipeline.search_formulas(
+            search.pattern,
+            limit=search.limit,
+            min_match=search.min_match
+        )
+    except PatternTooShortError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/analyze-math")
-async def analyze_math(analysis: MathAnalysis):
+def analyze_math(analysis: MathAnalysis):
     """
     Analyze a LaTeX expression
     """
+    # SymPy work is CPU-bound; as a plain def it runs in the threadpool instead of on the event loop
     try:
         expr = symbolic_processor.parse_expression(analysis.latex)
         if expr is None:
@@ -72,19 +201,20 @@ async def upload_files(files: List[UploadFile] = File(...)):
     - Vector indexes: created and stored in 'indexes' folder
     """
     try:
-        # Save PDFs to the pdfs folder first
+        # Save the uploads first (PDFs to the pdfs folder); UploadFile is only readable on the event loop
+        file_paths = []
         for file in files:
-            if file.name.lower().endswith('.pdf'):
-                pdf_path = Path("pdfs") / file.name
-                file_content = await file.read()
-                with open(pdf_path, "wb") as f:
-                    f.write(file_content)
-                
-                # Reset the file pointer to the beginning
-                await file.seek(0)
+            # Keep only the base name so a client cannot write outside the folder
+            file_name = Path(file.filename).name
+            folder = Path("pdfs") if file_name.lower().endswith('.pdf') else Path("uploads")
+            folder.mkdir(exist_ok=True)
+            file_path = folder / file_name
+            with open(file_path, "wb") as f:
+                f.write(await file.read())
+            file_paths.append(str(file_path))
         
         # Process documents using the RAG pipeline
-        error = rag.rag_pipeline(files)
+        error = await rag.arag_pipeline(file_paths)
         if error is not None:
             raise HTTPException(status_code=500, detail=str(error))
             
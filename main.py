@@ -2,9 +2,7 @@ import streamlit as st
 import os
 from pathlib import Path
 
-from utils.math_processor import MathProcessor
-from utils.symbolic_processor import SymbolicProcessor
-from utils.rag_pipeline import RagPipeline
+from utils import model_registry
 from components.ui_components import MathUI
 
 def setup_environment():
@@ -34,12 +32,12 @@ def main():
     st.title("Math-Enhanced Local RAG System")
     st.sidebar.title("Configuration")
 
-    # Initialize components
-    math_processor = MathProcessor()
-    symbolic_processor = SymbolicProcessor()
-    rag_pipeline = RagPipeline(math_processor, symbolic_processor)
-    # Set storage directory to indexes
-    rag_pipeline.storage_dir = "indexes"
+    # Initialize components (shared across Streamlit reruns)
+    rag_pipeline = model_registry.get_pipeline("indexes")
+    rag_pipeline.configure_chunking(
+        int(st.session_state.get("chunk_size", 1024)),
+        int(st.session_state.get("chunk_overlap", 200))
+    )
     ui = MathUI(rag_pipeline)
 
     # Sidebar controls
@@ -0,0 +1,128 @@
+"""
+Endpoint checks for the API server with mock models (no Ollama or Hugging Face needed).
+
+Usage:
+    python -m pytest tests
+"""
+import json
+from typing import Any, List, Optional
+
+import pytest
+from fastapi.testclient import TestClient
+from llama_index.core.base.llms.types import CompletionResponse
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from test_rag_pipeline import RecordingLLM, make_pipeline, write_pdf
+from utils import model_registry
+
+
+HEAT_PAGE = "Heat flows by $\\frac{\\partial u}{\\partial t} = u$ in rods"
+
+
+class ScriptedLLM(RecordingLLM):
+    """Mock LLM that streams fixed pieces, optionally failing before piece `fail_at`"""
+
+    pieces: List[str] = ["Heat ", "diffuses ", "along the rod."]
+    fail_at: Optional[int] = None
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        self.prompts.append(prompt)
+
+        def gen():
+            text = ""
+            for i, piece in enumerate(self.pieces):
+                if i == self.fail_at:
+                    raise RuntimeError("LLM connection lost")
+                text += piece
+                yield CompletionResponse(text=text, delta=piece)
+        return gen()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A client for the app with the shared "indexes" pipeline on mock models, run in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    import api
+
+    model_registry.clear(pipelines_only=True)
+    pipeline = make_pipeline("indexes")
+    monkeypatch.setitem(model_registry._pipelines, "indexes", pipeline)
+    pipeline.llm = ScriptedLLM()
+    monkeypatch.setattr(api, "rag_pipeline", pipeline)
+    # Not entered as a context manager, so the lifespan does not warm up the real models
+    yield TestClient(api.app)
+    model_registry.clear(pipelines_only=True)
+
+
+def upload_pdf(client, tmp_path, pages):
+    pdf = write_pdf(tmp_path / "source.pdf", pages)
+    with open(pdf, "rb") as f:
+        return client.post("/upload", files=[("files", ("paper.pdf", f.read(), "application/pdf"))])
+
+
+def test_upload_saves_and_indexes_pdfs(client, tmp_path):
+    response = upload_pdf(client, tmp_path, [HEAT_PAGE])
+
+    assert response.status_code == 200
+    assert (tmp_path / "pdfs" / "paper.pdf").exists()
+    found = client.post("/formulas", json={"latex": "\\frac{\\partial u}{\\partial t} = u"}).json()
+    assert found['total'] == 1
+    assert found['matches'][0]['metadata']['file_path'] == "pdfs/paper.pdf"
+
+
+def test_formula_search_rejects_patterns_too_short_for_ngrams(client, tmp_path):
+    upload_pdf(client, tmp_path, [HEAT_PAGE])
+
+    found = client.post("/formulas/search", json={"pattern": "\\partial u}{\\partial"}).json()
+    assert [match['metadata']['file_path'] for match in found['matches']] == ["pdfs/paper.pdf"]
+    response = client.post("/formulas/search", json={"pattern": "u ... t"})
+    assert response.status_code == 400
+    assert "at least 3" in response.json()['detail']
+
+
+def stream(client, question, sse=False):
+    """Status and decoded events of a /query/stream call, checking the framing on the way"""
+    headers = {"Accept": "text/event-stream"} if sse else {}
+    with client.stream("POST", "/query/stream", json={"question": question}, headers=headers) as response:
+        if response.status_code != 200:
+            return response.status_code, []
+        assert response.headers["content-type"].startswith("text/event-stream" if sse else "application/x-ndjson")
+        body = response.read().decode("utf-8")
+    if sse:
+        frames = body.split("\n\n")
+        assert frames.pop() == ""
+        assert all(frame.startswith("data: ") and "\n" not in frame for frame in frames)
+        lines = [frame[len("data: "):] for frame in frames]
+    else:
+        lines = body.split("\n")
+        assert lines.pop() == ""
+    return 200, [json.loads(line) for line in lines]
+
+
+@pytest.mark.parametrize("sse", [False, True])
+def test_query_stream_sends_sources_then_tokens_then_done(client, tmp_path, sse):
+    upload_pdf(client, tmp_path, [HEAT_PAGE])
+
+    status, events = stream(client, "How does heat flow in rods?", sse=sse)
+
+    assert status == 200
+    assert [event['type'] for event in events] == ["sources", "token", "token", "token", "done"]
+    assert events[0]['sources'][0]['metadata']['file_path'] == "pdfs/paper.pdf"
+    assert [event['text'] for event in events[1:-1]] == ScriptedLLM().pieces
+    assert "Heat diffuses along the rod." in events[-1]['answer']
+
+
+def test_query_stream_reports_errors(client, tmp_path):
+    # Failing before the stream starts is still a plain status code
+    assert stream(client, "How does heat flow in rods?")[0] == 500
+
+    upload_pdf(client, tmp_path, [HEAT_PAGE])
+    model_registry._pipelines["indexes"].llm.fail_at = 1
+
+    status, events = stream(client, "How does heat flow in rods?")
+
+    assert status == 200
+    assert [event['type'] for event in events] == ["sources", "token", "error"]
+    assert events[1]['text'] == "Heat "
+    assert "LLM connection lost" in events[-1]['detail']
@@ -0,0 +1,77 @@
+"""
+Checks for reciprocal rank fusion of dense and BM25 results on hand-built rankings.
+
+Usage:
+    python -m pytest tests
+"""
+from typing import List
+
+import pytest
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+from utils.hybrid_retriever import RRF_K, HybridRetriever, reciprocal_rank_fusion
+
+DENSE = ["a", "b", "c", "d"]
+SPARSE = ["b", "e", "c"]
+
+
+class FixedRetriever(BaseRetriever):
+    """Vector retriever stand-in returning the same ranked nodes for any query"""
+
+    def __init__(self, nodes: List[TextNode]):
+        self._nodes = nodes
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return [NodeWithScore(node=node, score=1.0 - i / 10) for i, node in enumerate(self._nodes)]
+
+
+class FixedBM25:
+    """BM25Index stand-in returning the same ranked ids for any query"""
+
+    def __init__(self, node_ids: List[str]):
+        self.node_ids = node_ids
+
+    def search(self, query, k, doc_ids=None):
+        return [(node_id, 10.0 - i) for i, node_id in enumerate(self.node_ids[:k])]
+
+
+def test_rrf_scores_sum_reciprocal_ranks():
+    scores = reciprocal_rank_fusion([DENSE, SPARSE])
+
+    assert scores == pytest.approx({
+        "a": 1 / (RRF_K + 1),
+        "b": 1 / (RRF_K + 2) + 1 / (RRF_K + 1),
+        "c": 1 / (RRF_K + 3) + 1 / (RRF_K + 3),
+        "d": 1 / (RRF_K + 4),
+        "e": 1 / (RRF_K + 2),
+    })
+    assert sorted(scores, key=scores.get, reverse=True) == ["b", "c", "a", "e", "d"]
+
+
+def test_rrf_k_damps_the_top_ranks():
+    # Without damping, a single first place (a) outweighs two third places (c)
+    scores = reciprocal_rank_fusion([DENSE, SPARSE], k=0)
+    assert sorted(scores, key=scores.get, reverse=True)[:3] == ["b", "a", "c"]
+
+
+def test_hybrid_retriever_fuses_and_deduplicates():
+    nodes = {node_id: TextNode(id_=node_id, text=f"node {node_id}") for node_id in "abcde"}
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(list(nodes.values()))
+    dense_nodes = [nodes[node_id] for node_id in DENSE]
+    retriever = HybridRetriever(
+        FixedRetriever(dense_nodes), FixedBM25(SPARSE), docstore,
+        similarity_top_k=4, candidate_k=10
+    )
+
+    results = retriever.retrieve("anything")
+
+    # b and c come back from both retrievers but appear once; e is only a BM25 hit, read from the docstore
+    assert [hit.node.node_id for hit in results] == ["b", "c", "a", "e"]
+    assert results[0].node is nodes["b"]
+    assert results[3].node.text == "node e"
+    expected = reciprocal_rank_fusion([DENSE, SPARSE])
+    assert [hit.score for hit in results] == [expected[hit.node.node_id] for hit in results]
@@ -0,0 +1,26 @@
+"""
+Checks for the single-pass math scanner in LatexSymbolsProcessor.
+
+Usage:
+    python -m pytest tests
+"""
+from utils.latex_symbols_processor import LatexSymbolsProcessor
+
+
+def scan(text):
+    return [(env['type'], env['content']) for env in LatexSymbolsProcessor().extract_math_environments(text)]
+
+
+def test_stray_dollar_does_not_swallow_blocks():
+    text = "cost $5 and $$x$$ and \\begin{align}a\\\\ b\\end{align} $y$"
+    assert scan(text) == [('display', 'x'), ('align', 'a\\\\ b'), ('inline', 'y')]
+
+
+def test_inline_and_display_in_text_order():
+    environments = LatexSymbolsProcessor().extract_math_environments("let $a+b$ and $c$ then $$d$$")
+    assert [(env['type'], env['content']) for env in environments] == [('inline', 'a+b'), ('inline', 'c'), ('display', 'd')]
+    assert [env['full'] for env in environments] == ["$a+b$", "$c$", "$$d$$"]
+
+
+def test_inline_math_does_not_cross_lines():
+    assert scan("price $3\nand $x$") == [('inline', 'x')]
@@ -0,0 +1,65 @@
+"""
+Checks for MathAwareNodeParser: equations stay whole and chunks stay within budget.
+
+Usage:
+    python -m pytest tests
+"""
+from llama_index.core import Document
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import get_tokenizer
+
+from utils.latex_symbols_processor import LatexSymbolsProcessor
+from utils.math_node_parser import MathAwareNodeParser
+
+TEXT = " ".join(
+    f"Step {i} rewrites the energy of the system in closed form. "
+    f"With $E_{i} = \\frac{{1}}{{2}} m v^2 + V(x_{i})$ we get $$\\int_0^{i} E_{i} \\, dt = W_{i}$$ and then "
+    f"\\begin{{align}}a_{i} &= b_{i} + c \\\\ d_{i} &= e_{i} - f\\end{{align}} which closes step {i}."
+    for i in range(12)
+)
+
+
+def chunk_spans(parser, text, metadata_str=""):
+    """(start, end) offsets of the chunks split_text_metadata_aware returns, found in order"""
+    spans = []
+    cursor = 0
+    for chunk in parser.split_text_metadata_aware(text, metadata_str):
+        start = text.index(chunk, cursor)
+        spans.append((start, start + len(chunk)))
+        cursor = start
+    return spans
+
+
+def test_math_spans_are_never_split_or_repeated():
+    environments = LatexSymbolsProcessor().extract_math_environments(TEXT)
+    assert {env['type'] for env in environments} == {'inline', 'display', 'align'}
+    parser = MathAwareNodeParser(chunk_size=60, chunk_overlap=30)
+    spans = chunk_spans(parser, TEXT)
+    assert len(spans) > 5
+
+    for env in environments:
+        for start, end in spans:
+            # A chunk holds the whole environment or none of it
+            assert end <= env['start'] or start >= env['end'] or (start <= env['start'] and env['end'] <= end)
+        # Overlap carries prose only, so every equation lands in exactly one chunk
+        assert sum(start <= env['start'] and env['end'] <= end for start, end in spans) == 1
+    # Consecutive chunks do overlap
+    assert any(next_start < end for (_, end), (next_start, _) in zip(spans, spans[1:]))
+
+
+def test_chunks_stay_within_the_budget():
+    tokenizer = get_tokenizer()
+    parser = MathAwareNodeParser(chunk_size=60, chunk_overlap=20)
+    for chunk in parser.split_text(TEXT):
+        assert len(tokenizer(chunk)) <= 60
+
+    document = Document(text=TEXT, metadata={'file_name': "energy.pdf", 'section': "Lagrangian mechanics"})
+    for node in parser.get_nodes_from_documents([document]):
+        assert len(tokenizer(node.get_content(metadata_mode=MetadataMode.ALL))) <= 60
+
+
+def test_equation_longer_than_the_budget_is_its_own_chunk():
+    equation = "$$" + " + ".join(f"a_{{{i}}} x^{{{i}}}" for i in range(60)) + "$$"
+    parser = MathAwareNodeParser(chunk_size=40, chunk_overlap=10)
+    chunks = parser.split_text(f"The series is {equation} for all x.")
+    assert equation in chunks
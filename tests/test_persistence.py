@@ -0,0 +1,407 @@
+"""
+Round-trip checks for the on-disk index formats: persist, load again, query.
+
+Usage:
+    python -m pytest tests
+"""
+import threading
+import time
+
+from typing import List
+
+import numpy as np
+import pytest
+from llama_index.core import MockEmbedding
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from utils.bm25_index import BM25Index
+from utils.embedding_cache import CachedEmbedding, EmbeddingCache
+from utils.formula_index import FormulaIndex
+from utils.latex_ngram_index import LatexNgramIndex, PatternTooShortError, decode_postings, encode_varints
+from utils.response_cache import ResponseCache
+from utils.symbol_index import SymbolIndex
+from utils.vector_store import MemmapVectorStore
+
+
+def make_node(node_id, text="", embedding=None, ref_doc_id=None, metadata=None):
+    node = TextNode(id_=node_id, text=text, embedding=embedding, metadata=metadata or {})
+    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id or node_id)
+    return node
+
+
+def math_node(doc_id, latex, metadata=None):
+    return make_node(f"{doc_id}-node", f"$${latex}$$", ref_doc_id=doc_id, metadata={'type': 'math', **(metadata or {})})
+
+
+def random_nodes(rng, prefix, count, dim=8):
+    return [
+        make_node(f"{prefix}{i}", embedding=rng.standard_normal(dim).tolist(), ref_doc_id=f"doc-{prefix}{i}")
+        for i in range(count)
+    ]
+
+
+def top_id(store, embedding, **kwargs):
+    return store.batch_query([embedding], 1, **kwargs)[0].ids[0]
+
+
+###################################
+#
+# Vector store segments and side table
+#
+###################################
+
+
+def test_vector_store_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    store = MemmapVectorStore()
+    nodes = random_nodes(rng, "a", 20)
+    store.add(nodes)
+    store.persist(str(tmp_path / "vector_store.json"))
+    store.add(random_nodes(rng, "b", 5))
+    store.delete("doc-a3")
+    store.persist(str(tmp_path / "vector_store.json"))
+
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert loaded.num_vectors == 24
+    assert isinstance(loaded._segments[0]['matrix'], np.memmap)
+    assert top_id(loaded, nodes[7].embedding) == "a7"
+    assert top_id(loaded, nodes[3].embedding) != "a3"
+    assert top_id(loaded, nodes[7].embedding, doc_ids=["doc-a5"]) == "a5"
+
+
+def test_vector_store_float16_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    store = MemmapVectorStore(dtype="float16")
+    nodes = random_nodes(rng, "h", 10)
+    store.add(nodes)
+    store.persist(str(tmp_path / "vector_store.json"))
+
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert loaded.dtype == "float16"
+    assert loaded._segments[0]['matrix'].dtype == np.float16
+    assert top_id(loaded, nodes[4].embedding) == "h4"
+
+
+def test_vector_store_tiered_compaction_keeps_large_segments(tmp_path):
+    rng = np.random.default_rng(2)
+    store = MemmapVectorStore(max_segments=4)
+    store.add(random_nodes(rng, "big", 200))
+    store.persist(str(tmp_path / "vector_store.json"))
+    big_file = store._segments[0]['file']
+    small = []
+    for batch in range(6):
+        nodes = random_nodes(rng, f"s{batch}-", 3)
+        small.extend(nodes)
+        store.add(nodes)
+        store.persist(str(tmp_path / "vector_store.json"))
+
+    assert len(store._segments) <= store.max_segments
+    # The large segment was never rewritten
+    assert store._segments[0]['file'] == big_file
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert loaded.num_vectors == 218
+    assert all(top_id(loaded, node.embedding) == node.node_id for node in small)
+    assert sorted(p.name for p in tmp_path.glob("vectors-*.npy")) == sorted(s['file'] for s in loaded._segments)
+
+
+def test_vector_store_compacts_tombstone_heavy_segment(tmp_path):
+    rng = np.random.default_rng(3)
+    store = MemmapVectorStore()
+    nodes = random_nodes(rng, "t", 10)
+    store.add(nodes)
+    store.persist(str(tmp_path / "vector_store.json"))
+    for i in range(5):
+        store.delete(f"doc-t{i}")
+    store.persist(str(tmp_path / "vector_store.json"))
+
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert sum(len(s['ids']) for s in loaded._segments) == 5
+    assert top_id(loaded, nodes[8].embedding) == "t8"
+
+
+def test_vector_store_queries_during_ingestion(tmp_path):
+    rng = np.random.default_rng(5)
+    store = MemmapVectorStore(max_segments=4)
+    store.add(random_nodes(rng, "q", 50))
+    errors, done = [], threading.Event()
+
+    def ingest():
+        try:
+            for batch in range(150):
+                store.add(random_nodes(rng, f"w{batch}-", 2))
+                store.delete(f"doc-w{batch - 5}-0")
+                if batch % 8 == 0:
+                    store.persist(str(tmp_path / "vector_store.json"))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    def query(seed):
+        queries = np.random.default_rng(seed).standard_normal((4, 8))
+        while not done.is_set():
+            try:
+                store.batch_query(queries, 5)
+                store.batch_query(queries, 5, doc_ids=["doc-q1", "doc-w3-1", "doc-w90-0"])
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=ingest)] + [threading.Thread(target=query, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert store.num_vectors == 50 + 2 * 150 - 145
+
+
+###################################
+#
+# IVF index
+#
+###################################
+
+
+def test_ivf_index_round_trip(tmp_path):
+    rng = np.random.default_rng(4)
+    store = MemmapVectorStore(ann_min_vectors=100, ann_nprobe=4)
+    nodes = random_nodes(rng, "v", 300, dim=16)
+    store.add(nodes)
+    store.persist(str(tmp_path / "vector_store.json"))
+    assert (tmp_path / "ivf_index.npz").exists()
+
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert loaded._ivf is not None
+    assert loaded._ivf.n_lists == store._ivf.n_lists
+    assert np.array_equal(loaded._segments[0]['lists'], store._segments[0]['lists'])
+    # Rows are written grouped by list, so a probe reads one slice per list
+    assert np.all(np.diff(loaded._segments[0]['lists']) >= 0)
+    assert loaded._segments[0]['offsets'][-1] == 300
+    # A stored vector always lands in its own list, so even approximate search finds it
+    assert top_id(loaded, nodes[42].embedding, nprobe=1) == "v42"
+    assert top_id(loaded, nodes[42].embedding, nprobe=0) == "v42"
+
+
+def test_ivf_search_over_grouped_and_tail_rows(tmp_path):
+    rng = np.random.default_rng(6)
+    store = MemmapVectorStore(ann_min_vectors=100)
+    nodes = random_nodes(rng, "g", 300, dim=16)
+    store.add(nodes)
+    store.persist(str(tmp_path / "vector_store.json"))
+    tail = random_nodes(rng, "t", 20, dim=16)
+    store.add(tail)
+    store.delete("doc-g7")
+
+    assert store._segments[-1]['offsets'] is None
+    assert all(top_id(store, node.embedding, nprobe=1) == node.node_id for node in nodes[:7] + tail)
+    assert top_id(store, nodes[7].embedding, nprobe=1) != "g7"
+    # Probing every list scores the same rows as exact search
+    queries = rng.standard_normal((5, 16))
+    segments = [dict(segment) for segment in store._segments]
+    masks = store._masks(segments, None, None)
+    for query in queries:
+        ann = store._ann_search(segments, store._ivf, query, 5, masks, store._ivf.n_lists)
+        exact = store._gathered_search(segments, query, 5, masks)
+        assert [hit[:2] for hit in ann] == [hit[:2] for hit in exact]
+
+    # A retrained index regroups the persisted rows
+    store.build_ann_index(n_lists=8)
+    store.persist(str(tmp_path / "vector_store.json"))
+    loaded = MemmapVectorStore.from_persist_dir(str(tmp_path))
+    assert all(segment['offsets'] is not None for segment in loaded._segments)
+    assert all(top_id(loaded, node.embedding, nprobe=1) == node.node_id for node in nodes[:7] + tail)
+    assert sorted(p.name for p in tmp_path.glob("vectors-*.npy")) == sorted(s['file'] for s in loaded._segments)
+
+
+###################################
+#
+# Lexical side indexes
+#
+###################################
+
+
+def test_varint_postings_round_trip():
+    ids = [0, 1, 5, 127, 128, 300, 16384, 2 ** 31]
+    data = bytearray()
+    encode_varints([b - a for a, b in zip([0] + ids[:-1], ids)], data)
+    assert decode_postings(bytes(data)).tolist() == ids
+    assert decode_postings(b"").tolist() == []
+
+
+def test_bm25_index_round_trip(tmp_path):
+    index = BM25Index()
+    index.add_nodes([
+        make_node("n1", "the gradient \\nabla f points uphill", ref_doc_id="d1"),
+        make_node("n2", "integrate by parts", ref_doc_id="d2"),
+        make_node("n3", "the divergence \\nabla \\cdot F", ref_doc_id="d3"),
+    ])
+    index.delete_ref_docs(["d3"])
+    index.persist(str(tmp_path))
+
+    loaded = BM25Index.from_persist_dir(str(tmp_path))
+    assert loaded.num_nodes == 2
+    assert loaded.search("\\nabla", 5) == index.search("\\nabla", 5)
+    assert [node_id for node_id, _ in loaded.search("integrate parts", 5)] == ["n2"]
+    assert loaded.search("\\nabla", 5, doc_ids=["d2"]) == []
+
+
+def test_formula_index_round_trip(tmp_path):
+    index = FormulaIndex()
+    index.add_nodes([math_node("d1", "a^2 + b^2 = c^2"), math_node("d2", "x^2 + y^2 = z^2")])
+    index.persist(str(tmp_path))
+
+    loaded = FormulaIndex.from_persist_dir(str(tmp_path))
+    assert loaded.num_documents == 2
+    assert loaded.lookup("a^2+b^2=c^2") == [("d1", "exact"), ("d2", "alpha")]
+    assert loaded.lookup("a^2+b^2=c^2", alpha_equivalent=False) == [("d1", "exact")]
+
+
+def test_symbol_index_round_trip(tmp_path):
+    index = SymbolIndex()
+    index.add_nodes([
+        math_node("d1", "\\nabla \\cdot E", {'symbols': {'calculus': ['\\nabla']}}),
+        math_node("d2", "\\oint E", {'symbols': {'calculus': ['\\oint']}}),
+    ])
+    index.persist(str(tmp_path))
+
+    loaded = SymbolIndex.from_persist_dir(str(tmp_path))
+    assert loaded.lookup(["nabla"]) == {"d1"}
+    assert loaded.lookup(["\\nabla", "\\oint"], match_all=False) == {"d1", "d2"}
+
+
+def test_latex_ngram_index_round_trip(tmp_path):
+    nodes = [
+        math_node("d1", "\\frac{\\partial u}{\\partial t} = \\alpha \\nabla^2 u"),
+        math_node("d2", "\\frac{d y}{d x} = k y"),
+        math_node("d3", "\\frac{\\partial p}{\\partial t} = 0"),
+        math_node("d4", "\\frac{d y}{d t} + \\frac{d x}{d x} = 0"),
+    ]
+    texts = {node.ref_doc_id: node.text for node in nodes}.get
+    index = LatexNgramIndex()
+    index.add_nodes(nodes)
+    index.delete_ref_docs(["d3"])
+    index.persist(str(tmp_path))
+
+    loaded = LatexNgramIndex.from_persist_dir(str(tmp_path))
+    assert loaded.num_formulas == 3
+    assert isinstance(loaded._lengths, np.ndarray)
+    assert [doc_id for doc_id, _ in loaded.search("\\frac{\\partial ...}{\\partial t}", texts=texts)] == ["d1"]
+    assert loaded.search("\\frac{d y}{d x}", texts=texts) == index.search("\\frac{d y}{d x}", texts=texts)
+    # d4 shares every n-gram of the pattern but not as one sub-expression
+    assert [doc_id for doc_id, _ in loaded.search("\\frac{d y}{d x}", texts=texts)] == ["d2"]
+    assert {doc_id for doc_id, _ in loaded.search("\\frac{d y}{d x}")} == {"d2", "d4"}
+    with pytest.raises(PatternTooShortError):
+        loaded.search("\\alpha ... u")
+
+
+def test_latex_ngram_index_compaction_keeps_postings(tmp_path):
+    nodes = [math_node(f"d{i}", f"\\frac{{a_{i}}}{{b}} + c") for i in range(6)]
+    texts = {node.ref_doc_id: node.text for node in nodes}.get
+    index = LatexNgramIndex()
+    index.add_nodes(nodes)
+    index.delete_ref_docs(["d0", "d1", "d2", "d4"])
+    index.persist(str(tmp_path))
+
+    # Persisting over half-deleted ids renumbers the live formulas
+    assert index._doc_ids == ["d3", "d5"]
+    loaded = LatexNgramIndex.from_persist_dir(str(tmp_path))
+    assert sorted(doc_id for doc_id, _ in loaded.search("}{b} + c", texts=texts)) == ["d3", "d5"]
+    assert loaded.search("\\frac{a_5}", texts=texts) == [("d5", 1.0)]
+
+
+###################################
+#
+# Response cache
+#
+###################################
+
+
+def test_response_cache_writes_on_flush_only(tmp_path):
+    path = tmp_path / ResponseCache.FNAME
+    cache = ResponseCache(path=str(path), flush_interval=60)
+    cache.put("k1", {'answer': "one"})
+    cache.put("k2", {'answer': "two"})
+    assert not path.exists()
+    cache.flush()
+
+    loaded = ResponseCache(path=str(path))
+    assert len(loaded) == 2
+    assert loaded.get("k2") == {'answer': "two"}
+
+
+def test_response_cache_flushes_in_the_background(tmp_path):
+    path = tmp_path / ResponseCache.FNAME
+    cache = ResponseCache(path=str(path), flush_interval=0.05)
+    cache.put("k1", {'answer': "one"})
+    deadline = time.monotonic() + 5
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ResponseCache(path=str(path)).get("k1") == {'answer': "one"}
+
+
+###################################
+#
+# Embedding cache
+#
+###################################
+
+
+class RecordingEmbedding(MockEmbedding):
+    """MockEmbedding that records the texts it embeds"""
+
+    texts: List[str] = []
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.texts.extend(texts)
+        return super()._get_text_embeddings(texts)
+
+
+def test_embedding_cache_hits_misses_and_eviction(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite"), max_entries=10)
+    old = {EmbeddingCache.key("m", f"old {i}"): [float(i)] * 4 for i in range(5)}
+    recent = {EmbeddingCache.key("m", f"recent {i}"): [float(i)] * 4 for i in range(5)}
+    cache.put_many(old)
+    time.sleep(0.01)
+    cache.put_many(recent)
+    assert len(cache) == 10
+
+    # Whitespace is normalized, the model name is not
+    assert EmbeddingCache.key("m", "  old\n 1 ") == EmbeddingCache.key("m", "old 1")
+    found = cache.get_many([EmbeddingCache.key("m", "old 1"), EmbeddingCache.key("other", "old 1")])
+    assert found == {EmbeddingCache.key("m", "old 1"): [1.0] * 4}
+
+    # Reading the old entries marks them as recently used, so the untouched ones go first
+    time.sleep(0.01)
+    assert len(cache.get_many(list(old))) == 5
+    time.sleep(0.01)
+    cache.put_many({EmbeddingCache.key("m", "new"): [9.0] * 4})
+    assert len(cache) == 9
+    kept = cache.get_many([*old, *recent, EmbeddingCache.key("m", "new")])
+    assert set(old) <= set(kept)
+    assert EmbeddingCache.key("m", "new") in kept
+    assert len(set(recent) & set(kept)) == 3
+    cache.close()
+
+
+def test_cached_embedding_embeds_misses_only(tmp_path):
+    inner = RecordingEmbedding(embed_dim=4)
+    model = CachedEmbedding(inner, EmbeddingCache(path=str(tmp_path / "embeddings.sqlite")))
+    model.get_text_embedding_batch(["a", "b"])
+    model.get_text_embedding_batch(["b", "c", "a"])
+    assert inner.texts == ["a", "b", "c"]
+
+
+def test_cached_embedding_batches_queries_with_the_instruction(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite"))
+    inner = RecordingEmbedding(embed_dim=4)
+    model = CachedEmbedding(inner, cache, query_instruction="Query: ")
+    assert len(model.get_query_embedding_batch(["x", "y"])) == 2
+    assert inner.texts == ["Query: x", "Query: y"]
+    assert len(cache) == 0
+
+    # Without a known instruction each query goes through the inner model's query API
+    inner = RecordingEmbedding(embed_dim=4)
+    model = CachedEmbedding(inner, cache)
+    assert len(model.get_query_embedding_batch(["x", "y"])) == 2
+    assert inner.texts == []
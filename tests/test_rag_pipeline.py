@@ -0,0 +1,237 @@
+"""
+Query-path checks for RagPipeline with mock models (no Ollama or Hugging Face needed).
+
+Usage:
+    python -m pytest tests
+"""
+import threading
+import time
+from typing import Any, List
+
+import pytest
+
+from llama_index.core import Document, Settings
+from llama_index.core.base.llms.types import LLMMetadata
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import get_tokenizer
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from utils.math_processor import MathProcessor
+from utils.model_registry import LLM_CONTEXT_WINDOW
+from utils.rag_pipeline import CHUNK_THREADS, LONG_QUESTION_CHARS, SYSTEM_PROMPT, RagPipeline
+from utils.symbolic_processor import SymbolicProcessor
+
+
+class RecordingLLM(MockLLM):
+    """MockLLM with Ollama's context window that keeps every prompt it is sent"""
+
+    prompts: List[str] = []
+    model: str = "recording"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=LLM_CONTEXT_WINDOW, num_output=256, model_name=self.model)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        self.prompts.append(prompt)
+        return super().complete(prompt, formatted=formatted, **kwargs)
+
+
+class CountingEmbedding(MockEmbedding):
+    """MockEmbedding that counts the texts it embeds"""
+
+    texts: int = 0
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        self.texts += len(texts)
+        return super()._get_text_embeddings(texts)
+
+
+def make_pipeline(tmp_path):
+    pipeline = RagPipeline(MathProcessor(), SymbolicProcessor(), storage_dir=str(tmp_path), lazy=True)
+    pipeline.embedding_model = Settings.embed_model = CountingEmbedding(embed_dim=8)
+    pipeline.llm = Settings.llm = RecordingLLM()
+    return pipeline
+
+
+def write_pdf(path, pages):
+    """A PDF with one line of text per page"""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for text in pages:
+        page = writer.add_blank_page(612, 792)
+        content = DecodedStreamObject()
+        escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        content.set_data(f"BT /F1 12 Tf 72 720 Td ({escaped}) Tj ET".encode("latin-1"))
+        page[NameObject("/Contents")] = writer._add_object(content)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+    writer.write(str(path))
+    return str(path)
+
+
+def test_reingesting_a_pdf_embeds_only_changed_pages(tmp_path):
+    pipeline = make_pipeline(tmp_path / "index")
+    pages = [
+        "Heat flows by $\\frac{\\partial u}{\\partial t} = u$ in rods",
+        "Waves obey $y'' = -y$ on strings",
+        "Circulation $\\oint E$ around loops is zero",
+    ]
+    pdf = write_pdf(tmp_path / "paper.pdf", pages)
+    assert pipeline.ingest_pdf(pdf) == 9
+    docstore = pipeline.index.docstore
+    vectors = pipeline.index.vector_store.num_vectors
+
+    embedded = pipeline.embedding_model.texts
+    assert pipeline.ingest_pdf(write_pdf(tmp_path / "paper.pdf", pages)) == 0
+    assert pipeline.embedding_model.texts == embedded
+
+    # A changed page re-embeds only its own nodes
+    before = {ref_doc_id: info.node_ids for ref_doc_id, info in docstore.get_all_ref_doc_info().items()}
+    pages[1] = "Waves obey $y'' = -4y$ on strings"
+    changed = pipeline.ingest_pdf(write_pdf(tmp_path / "paper.pdf", pages))
+    after = {ref_doc_id: info.node_ids for ref_doc_id, info in docstore.get_all_ref_doc_info().items()}
+    rewritten = [ref_doc_id for ref_doc_id in after if after[ref_doc_id] != before[ref_doc_id]]
+    assert changed == len(rewritten) > 0
+    assert all(ref_doc_id.startswith(f"{pdf}:p2:") for ref_doc_id in rewritten)
+    assert pipeline.embedding_model.texts == embedded + sum(len(after[ref_doc_id]) for ref_doc_id in rewritten)
+    assert pipeline.index.vector_store.num_vectors == vectors
+
+    # A dropped page leaves the docstore, the vector store and the side indexes
+    page_three = [ref_doc_id for ref_doc_id in after if ref_doc_id.startswith(f"{pdf}:p3:")]
+    page_three_nodes = sum(len(docstore.get_ref_doc_info(ref_doc_id).node_ids) for ref_doc_id in page_three)
+    assert len(page_three) == 3 and pipeline.symbol_index.lookup(["\\oint"])
+    assert pipeline.ingest_pdf(write_pdf(tmp_path / "paper.pdf", pages[:2])) == 0
+    assert not any(docstore.document_exists(ref_doc_id) for ref_doc_id in page_three)
+    assert set(docstore.get_all_ref_doc_info()).isdisjoint(page_three)
+    assert pipeline.index.vector_store.num_vectors == vectors - page_three_nodes
+    assert pipeline.symbol_index.lookup(["\\oint"]) == set()
+    assert pipeline.find_formula("\\oint E")['total'] == 0
+    assert pipeline.bm25_index.search("circulation loops", 5) == []
+
+
+def test_merged_long_question_fits_the_context_window(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.ingest([
+        Document(text=f"Section {i}. " + "The divergence theorem relates flux to divergence. " * 30)
+        for i in range(40)
+    ])
+    question = "Explain how the divergence theorem is used here. " * (2 * LONG_QUESTION_CHARS // 50)
+
+    result = pipeline.query(question, top_k=20, chunk_mode="merge")
+
+    assert result['answer']
+    # One LLM call (no refine pass), and its prompt plus the system prompt and the answer fit in num_ctx
+    assert len(pipeline.llm.prompts) == 1
+    tokenizer = get_tokenizer()
+    assert len(tokenizer(pipeline.llm.prompts[0])) + len(tokenizer(SYSTEM_PROMPT)) + 256 <= LLM_CONTEXT_WINDOW
+    assert 1 < len(result['sources']) < 20
+
+
+def slow_retrieval(monkeypatch, query_engine, seconds):
+    """Make query_engine.retrieve sleep; returns the most retrievals seen running at once"""
+    retrieve = query_engine.retrieve
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def slow(bundle):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(seconds)
+        with lock:
+            running[0] -= 1
+        return retrieve(bundle)
+
+    monkeypatch.setattr(query_engine, "retrieve", slow)
+    return peak
+
+
+def test_chunked_question_retrieves_in_bounded_parallel_and_merges_under_budget(tmp_path, monkeypatch):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.ingest([Document(text=f"Lemma {i}. " + "Compact sets are closed and bounded. " * 10) for i in range(30)])
+    query_engine = pipeline._query_engine(5)
+    peak = slow_retrieval(monkeypatch, query_engine, 0.05)
+    question = "Why are compact sets closed? " * (20 * LONG_QUESTION_CHARS // 29)
+
+    chunks = pipeline._split_question(question)
+    assert len(chunks) == 20 and "".join(chunks) == question
+    pipeline._map_before(query_engine.retrieve, pipeline._chunk_bundles(chunks), time.monotonic() + 30)
+    assert 1 < peak[0] <= CHUNK_THREADS
+
+    # Nodes found by several chunks are kept once, as many as fit the budget
+    question = "Why are compact sets closed? " * (2 * LONG_QUESTION_CHARS // 29)
+    pipeline.merge_context_tokens = 300
+    nodes = pipeline._merged_chunk_nodes(query_engine, question, pipeline._split_question(question),
+                                         time.monotonic() + 30)
+    assert len({hit.node.node_id for hit in nodes}) == len(nodes) > 1
+    tokenizer = get_tokenizer()
+    assert sum(len(tokenizer(hit.node.get_content(metadata_mode=MetadataMode.LLM))) for hit in nodes) <= 300
+
+
+def test_chunked_question_fails_at_the_deadline(tmp_path, monkeypatch):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.ingest([Document(text="Compact sets are closed and bounded.")])
+    slow_retrieval(monkeypatch, pipeline._query_engine(3), 1.0)
+    pipeline.query_timeout = 0.2
+    question = "Why are compact sets closed? " * (3 * LONG_QUESTION_CHARS // 29)
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pipeline.query(question, top_k=3)
+    assert time.monotonic() - started < 1.0
+
+
+def test_merge_budget_shrinks_with_the_question(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.ingest([Document(text="Stokes' theorem generalizes Green's theorem.")])
+    query_engine = pipeline._query_engine(3)
+
+    short = pipeline._merge_context_budget(query_engine, "What is Stokes' theorem?")
+    long = pipeline._merge_context_budget(query_engine, "What is Stokes' theorem? " * 100)
+    assert 0 < long < short < LLM_CONTEXT_WINDOW
+    # A question that fills the window on its own leaves no room for context
+    assert pipeline._merge_context_budget(query_engine, "theorem " * LLM_CONTEXT_WINDOW) == 0
+    pipeline.merge_context_tokens = 100
+    assert pipeline._merge_context_budget(query_engine, "What is Stokes' theorem?") == 100
+
+
+def test_semantic_cache_is_opt_in_and_scoped_by_the_math(tmp_path):
+    assert make_pipeline(tmp_path).semantic_cache is None
+
+    pipeline = RagPipeline(MathProcessor(), SymbolicProcessor(), storage_dir=str(tmp_path), lazy=True,
+                           semantic_cache=True)
+    scope = "options"
+    squared = pipeline._semantic_scope("What is $\\int x^2 dx$?", scope)
+    assert pipeline._semantic_scope("Please integrate $\\int x^{2} dx$", scope) == squared
+    assert pipeline._semantic_scope("What is $\\int x^3 dx$?", scope) != squared
+
+
+def test_response_cache_key_covers_question_options_model_and_index(tmp_path):
+    pipeline = make_pipeline(tmp_path)
+    pipeline.ingest([Document(text="Stokes' theorem generalizes Green's theorem.")])
+
+    def key(question="What is  $\\int x^2 dx$?", top_k=3):
+        return pipeline._plan_query(question, top_k, None, None, "vector", "concurrent")['cache_key']
+
+    asked = key()
+    # Whitespace, case and formula spelling are normalized away
+    assert key("what is $\\int x^{2} dx$?") == asked
+    assert key("What is $\\int x^3 dx$?") != asked
+    assert key(top_k=4) != asked
+    other = RecordingLLM()
+    other.model = "other"
+    pipeline.llm = other
+    assert key() != asked
+    asked = key()
+    pipeline.ingest([Document(text="The divergence theorem relates flux to divergence.")])
+    assert key() != asked
@@ -0,0 +1,84 @@
+import math
+from typing import Dict
+
+import numpy as np
+
+from utils import logs
+from utils.vector_search import CHUNK_ROWS, normalize_rows, top_k_indices
+
+
+class IVFIndex:
+    """Inverted-file (IVF-flat) approximate nearest neighbour index.
+
+    Vectors are bucketed by their nearest spherical k-means centroid; a query only
+    scores the rows in its `nprobe` closest buckets. `nprobe` is the recall/latency
+    knob: more probes means higher recall and more rows scored.
+    """
+
+    def __init__(self, centroids: np.ndarray, trained_size: int):
+        self.centroids = normalize_rows(centroids)
+        self.trained_size = trained_size
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def default_n_lists(n: int) -> int:
+        """Roughly sqrt(n) lists keeps both centroid probing and list scans small"""
+        return max(1, int(math.sqrt(n)))
+
+    @classmethod
+    def train(cls, sample: np.ndarray, n_lists: int, trained_size: int,
+              iterations: int = 10, seed: int = 0) -> "IVFIndex":
+        """Fit centroids with spherical k-means on a sample of the indexed rows"""
+        rng = np.random.default_rng(seed)
+        sample = normalize_rows(sample)
+        sample_size = sample.shape[0]
+        n_lists = min(n_lists, sample_size)
+        centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~np.bincount(assignments, minlength=n_lists).astype(bool)
+            # Re-seed empty lists from random sample rows so no centroid is wasted
+            sums[empty] = sample[rng.choice(sample_size, size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        logs.log.info(f"Trained IVF index with {n_lists} lists on {sample_size:,} of {trained_size:,} vectors")
+        return cls(centroids, trained_size=trained_size)
+
+    def assign(self, matrix: np.ndarray) -> np.ndarray:
+        """Nearest centroid for each row, as an int32 list id"""
+        lists = np.empty(matrix.shape[0], dtype=np.int32)
+        for start in range(0, matrix.shape[0], CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+            lists[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return lists
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """The `nprobe` lists whose centroids are closest to a query"""
+        scores = self.centroids @ normalize_rows(query)[0]
+        return top_k_indices(scores, min(nprobe, self.n_lists))
+
+    def save(self, path: str, segment_lists: Dict[str, np.ndarray]) -> None:
+        """Write centroids and per-segment list assignments to an .npz file"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            trained_size=np.asarray(self.trained_size),
+            **{f"lists__{name}": lists for name, lists in segment_lists.items()}
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        """Read an index saved with save(); returns (index, per-segment assignments)"""
+        with np.load(path) as data:
+            index = cls(data["centroids"], int(data["trained_size"]))
+            segment_lists = {
+                key[len("lists__"):]: data[key]
+                for key in data.files if key.startswith("lists__")
+            }
+        return index, segment_lists
@@ -0,0 +1,140 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils import logs
+
+# LaTeX commands keep their backslash and case (\Gamma is not \gamma); words are lowercased
+_TOKEN_PATTERN = re.compile(r"\\[A-Za-z]+|[A-Za-z]+|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into LaTeX command, word and number tokens"""
+    return [
+        token if token.startswith('\\') else token.lower()
+        for token in _TOKEN_PATTERN.findall(text)
+    ]
+
+
+class BM25Index:
+    """In-process Okapi BM25 index over node text and the 'searchable_text' metadata.
+
+    Complements dense retrieval for lexical matches (exact LaTeX commands and
+    symbol names) that the embedding model handles poorly.
+    """
+
+    FNAME = "bm25_index.json"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        # term -> {node_id: term frequency}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._lengths: Dict[str, int] = {}
+        # node_id -> distinct terms, so a delete only touches that node's postings
+        self._node_terms: Dict[str, List[str]] = {}
+        self._ref_docs: Dict[str, List[str]] = {}
+        self._total_length = 0
+
+    @staticmethod
+    def node_text(node: Any) -> str:
+        return f"{node.text} {node.metadata.get('searchable_text', '')}"
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self._lengths)
+
+    def add_nodes(self, nodes: Iterable[Any]) -> None:
+        with self._lock:
+            for node in nodes:
+                if node.node_id in self._lengths:
+                    self._remove_node(node.node_id)
+                self._add(node.node_id, node.ref_doc_id, tokenize(self.node_text(node)))
+
+    def _add(self, node_id: str, ref_doc_id: Optional[str], tokens: List[str]) -> None:
+        counts = Counter(tokens)
+        for term, freq in counts.items():
+            self._postings.setdefault(term, {})[node_id] = freq
+        self._node_terms[node_id] = list(counts)
+        self._lengths[node_id] = len(tokens)
+        self._total_length += len(tokens)
+        ref_nodes = self._ref_docs.setdefault(ref_doc_id or node_id, [])
+        if node_id not in ref_nodes:
+            ref_nodes.append(node_id)
+
+    def delete_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        with self._lock:
+            for ref_doc_id in ref_doc_ids:
+                for node_id in self._ref_docs.pop(ref_doc_id, ()):
+                    self._remove_node(node_id)
+
+    def _remove_node(self, node_id: str) -> None:
+        self._total_length -= self._lengths.pop(node_id)
+        for term in self._node_terms.pop(node_id):
+            del self._postings[term][node_id]
+            if not self._postings[term]:
+                del self._postings[term]
+
+    def search(self, query: str, k: int, doc_ids: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """Top-k (node_id, score) pairs for a query, best first, optionally restricted to ref doc ids"""
+        with self._lock:
+            n = len(self._lengths)
+            if n == 0 or k <= 0:
+                return []
+            allowed = None
+            if doc_ids is not None:
+                allowed = {node_id for doc_id in doc_ids for node_id in self._ref_docs.get(doc_id, ())}
+            avg_length = self._total_length / n
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for node_id, freq in posting.items():
+                    if allowed is not None and node_id not in allowed:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[node_id] / avg_length)
+                    scores[node_id] = scores.get(node_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def persist(self, persist_dir: str) -> None:
+        """Atomically write the index to persist_dir"""
+        with self._lock:
+            data = {
+                "k1": self.k1,
+                "b": self.b,
+                "postings": self._postings,
+                "lengths": self._lengths,
+                "ref_docs": self._ref_docs,
+            }
+            path = os.path.join(persist_dir, self.FNAME)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> Optional["BM25Index"]:
+        """Load a persisted index, or None if persist_dir has none"""
+        path = os.path.join(persist_dir, cls.FNAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        index = cls(k1=data["k1"], b=data["b"])
+        index._postings = data["postings"]
+        index._lengths = data["lengths"]
+        index._ref_docs = data["ref_docs"]
+        index._total_length = sum(index._lengths.values())
+        for term, posting in index._postings.items():
+            for node_id in posting:
+                index._node_terms.setdefault(node_id, []).append(term)
+        logs.log.info(f"Loaded BM25 index over {index.num_nodes:,} nodes and {len(index._postings):,} terms")
+        return index
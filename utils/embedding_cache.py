@@ -0,0 +1,170 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from utils import logs
+
+
+class EmbeddingCache:
+    """Content-addressed on-disk store of embeddings with LRU eviction"""
+
+    def __init__(self, path: str = "cache/embeddings.sqlite", max_entries: int = 100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        logs.log.info(f"Embedding cache opened at {path} with {self._count:,} entries")
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        """Hash of the model name and whitespace-normalized text"""
+        normalized = re.sub(r'\s+', ' ', text.strip())
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """Fetch cached embeddings for the given keys, marking them as recently used"""
+        found = {}
+        if not keys:
+            return found
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = list(keys[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                        [time.time(), *batch]
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """Store embeddings and evict the least recently used entries over the size limit"""
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                rows
+            )
+            self._count += self._conn.total_changes - before
+            if self._count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Drop the oldest entries down to 90% of max_entries"""
+        target = int(self.max_entries * 0.9)
+        excess = self._count - target
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (excess,)
+        )
+        self._count = target
+        logs.log.info(f"Embedding cache evicted {excess:,} least recently used entries")
+
+    def close(self) -> None:
+        """Close the SQLite connection; the cache cannot be used afterwards"""
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that consults an EmbeddingCache before embedding text"""
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _query_instruction: Optional[str] = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache,
+                 lookup_batch_size: int = 256, query_instruction: Optional[str] = None,
+                 **kwargs: Any):
+        # Cache lookups run in large batches; misses are still embedded at the
+        # inner model's own (memory-bound) batch size
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=max(lookup_batch_size, inner.embed_batch_size),
+            **kwargs
+        )
+        self._inner = inner
+        self._cache = cache
+        # Prefix that turns a text embedding of the inner model into its query
+        # embedding; None when no such prefix is known
+        self._query_instruction = query_instruction
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._inner.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._inner.aget_query_embedding(query)
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """Query embeddings for several questions, batched when the query instruction is known"""
+        if self._query_instruction is None:
+            return [self._inner.get_query_embedding(query) for query in queries]
+        # Not cached: questions rarely repeat verbatim and would crowd out passage entries
+        return self._inner.get_text_embedding_batch(
+            [self._query_instruction + query for query in queries]
+        )
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._cache.key(self.model_name, text) for text in texts]
+        cached = self._cache.get_many(keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            computed = self._inner.get_text_embedding_batch([texts[i] for i in missing])
+            new_items = {keys[i]: vector for i, vector in zip(missing, computed)}
+            self._cache.put_many(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
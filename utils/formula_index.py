@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils import logs
+from utils.latex_symbols_processor import SYMBOL_VOCABULARY, LatexSymbolsProcessor, tokenize_math
+
+_SYMPY_SYMBOL = re.compile(r"Symbol\('([^']*)'")
+# Tokens renamed for alpha-equivalence besides single Latin letters; \pi is a constant
+_VARIABLE_COMMANDS = {'\\' + name for name in SYMBOL_VOCABULARY['greek'] if name != 'pi'}
+
+
+def _is_variable(token: str) -> bool:
+    return (len(token) == 1 and token.isalpha()) or token in _VARIABLE_COMMANDS
+
+
+class FormulaIndex:
+    """Hash index of canonicalized formulas for exact and alpha-equivalent lookup.
+
+    Every math node is reduced to two structural hashes: one of its canonical
+    token (or, with use_sympy, SymPy expression) form and one with variables
+    renamed in order of first appearance, so x^2 + y and a^2 + b hash alike.
+    Both map to the ref doc ids stating that formula.
+    """
+
+    FNAME = "formula_index.json"
+
+    def __init__(self, use_sympy: bool = False):
+        # SymPy parsing also equates commutative reorderings, but costs ~ms per formula
+        self.use_sympy = use_sympy
+        self.latex_processor = LatexSymbolsProcessor()
+        self._symbolic_processor = None
+        self._lock = threading.Lock()
+        self._exact: Dict[str, Set[str]] = {}
+        self._alpha: Dict[str, Set[str]] = {}
+        self._doc_hashes: Dict[str, Tuple[str, str]] = {}
+
+    @property
+    def num_documents(self) -> int:
+        return len(self._doc_hashes)
+
+    ###################################
+    #
+    # Canonicalization
+    #
+    ###################################
+
+    def canonical_forms(self, latex: str) -> Tuple[str, str]:
+        """Canonical (exact, alpha-renamed) forms of a formula's content (no $ or environment)"""
+        if self.use_sympy:
+            forms = self._sympy_forms(latex)
+            if forms is not None:
+                return forms
+
+        normalized = self.latex_processor.normalize_math_expression(latex)
+        tokens = tokenize_math(normalized)
+        names: Dict[str, str] = {}
+        renamed = [names.setdefault(t, f"v{len(names)}") if _is_variable(t) else t for t in tokens]
+        return " ".join(tokens), " ".join(renamed)
+
+    def _sympy_forms(self, latex: str) -> Optional[Tuple[str, str]]:
+        import sympy
+        if self._symbolic_processor is None:
+            from utils.symbolic_processor import SymbolicProcessor
+            self._symbolic_processor = SymbolicProcessor()
+        expr = self._symbolic_processor.parse_expression(latex)
+        if expr is None:
+            return None
+        exact = sympy.srepr(expr)
+        names: Dict[str, str] = {}
+        renamed = _SYMPY_SYMBOL.sub(
+            lambda m: f"Symbol('{names.setdefault(m.group(1), f'v{len(names)}')}'", exact
+        )
+        return "sympy:" + exact, "sympy:" + renamed
+
+    def hashes(self, latex: str) -> Tuple[str, str]:
+        """Structural (exact, alpha-equivalent) hashes of a formula's content"""
+        return tuple(
+            hashlib.blake2b(form.encode('utf-8'), digest_size=16).hexdigest()
+            for form in self.canonical_forms(latex)
+        )
+
+    ###################################
+    #
+    # Index maintenance and lookup
+    #
+    ###################################
+
+    def add_nodes(self, nodes: Iterable[Any]) -> None:
+        for node in nodes:
+            if node.metadata.get('type') != 'math':
+                continue
+            content = self.latex_processor.formula_content(node.text)
+            if not content or not content.strip():
+                continue
+            exact, alpha = self.hashes(content)
+            doc_id = node.ref_doc_id or node.node_id
+            with self._lock:
+                self._doc_hashes[doc_id] = (exact, alpha)
+                self._exact.setdefault(exact, set()).add(doc_id)
+                self._alpha.setdefault(alpha, set()).add(doc_id)
+
+    def delete_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        with self._lock:
+            for doc_id in ref_doc_ids:
+                hashes = self._doc_hashes.pop(doc_id, None)
+                if hashes is None:
+                    continue
+                for table, key in ((self._exact, hashes[0]), (self._alpha, hashes[1])):
+                    table[key].discard(doc_id)
+                    if not table[key]:
+                        del table[key]
+
+    def lookup(self, latex: str, alpha_equivalent: bool = True) -> List[Tuple[str, str]]:
+        """(ref doc id, 'exact' | 'alpha') for every indexed statement of a formula, exact matches first"""
+        exact, alpha = self.hashes(latex)
+        with self._lock:
+            exact_ids = sorted(self._exact.get(exact, ()))
+            matches = [(doc_id, 'exact') for doc_id in exact_ids]
+            if alpha_equivalent:
+                seen = set(exact_ids)
+                matches.extend(
+                    (doc_id, 'alpha') for doc_id in sorted(self._alpha.get(alpha, ())) if doc_id not in seen
+                )
+        return matches
+
+    ###################################
+    #
+    # Persistence
+    #
+    ###################################
+
+    def persist(self, persist_dir: str) -> None:
+        """Atomically write the per-document hashes to persist_dir"""
+        with self._lock:
+            data = {"use_sympy": self.use_sympy, "documents": self._doc_hashes}
+            path = os.path.join(persist_dir, self.FNAME)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> Optional["FormulaIndex"]:
+        """Load a persisted index, or None if persist_dir has none"""
+        path = os.path.join(persist_dir, cls.FNAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        # Keep the canonicalization the stored hashes were built with
+        index = cls(use_sympy=data["use_sympy"])
+        for doc_id, (exact, alpha) in data["documents"].items():
+            index._doc_hashes[doc_id] = (exact, alpha)
+            index._exact.setdefault(exact, set()).add(doc_id)
+            index._alpha.setdefault(alpha, set()).add(doc_id)
+        logs.log.info(f"Loaded formula index over {index.num_documents:,} formulas")
+        return index
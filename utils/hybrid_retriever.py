@@ -0,0 +1,61 @@
+from typing import Dict, List, Optional, Sequence
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+
+from utils.bm25_index import BM25Index
+
+# Standard RRF damping constant; keeps the top few ranks of either list from dominating
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> Dict[str, float]:
+    """Fuse ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, node_id in enumerate(ranking, start=1):
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+class HybridRetriever(BaseRetriever):
+    """Dense + BM25 retrieval merged with reciprocal rank fusion.
+
+    Both retrievers return `candidate_k` results each and the fused top
+    `similarity_top_k` are kept, so lexical hits reach the prompt without
+    raising top_k.
+    """
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        bm25_index: BM25Index,
+        docstore: BaseDocumentStore,
+        similarity_top_k: int,
+        candidate_k: int,
+        doc_ids: Optional[List[str]] = None,
+    ):
+        self._vector_retriever = vector_retriever
+        self._bm25_index = bm25_index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        self._candidate_k = candidate_k
+        self._doc_ids = doc_ids
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense = self._vector_retriever.retrieve(query_bundle)
+        sparse = self._bm25_index.search(query_bundle.query_str, self._candidate_k, doc_ids=self._doc_ids)
+
+        fused = reciprocal_rank_fusion([
+            [hit.node.node_id for hit in dense],
+            [node_id for node_id, _ in sparse],
+        ])
+        best = sorted(fused, key=fused.get, reverse=True)[:self._similarity_top_k]
+
+        nodes = {hit.node.node_id: hit.node for hit in dense}
+        missing = [node_id for node_id in best if node_id not in nodes]
+        if missing:
+            nodes.update((node.node_id, node) for node in self._docstore.get_nodes(missing, raise_error=False))
+        return [NodeWithScore(node=nodes[node_id], score=fused[node_id]) for node_id in best if node_id in nodes]
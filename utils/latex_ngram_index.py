@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import struct
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils import logs
+from utils.latex_symbols_processor import LatexSymbolsProcessor, tokenize_math
+
+# "..." (or \dots, \ldots, \cdots) in a pattern matches any run of tokens
+_WILDCARD = re.compile(r"\.\.\.|\\[lc]?dots\b")
+
+
+class PatternTooShortError(ValueError):
+    """A search pattern with no n-gram to look up"""
+
+
+def encode_varints(values: Iterable[int], out: bytearray) -> None:
+    """Append non-negative ints to out as LEB128 varints (7 bits per byte)"""
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_postings(data: bytes) -> np.ndarray:
+    """Decode a delta + varint posting list back into ascending ids (vectorized)"""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if raw.size == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(ends.size), ends - starts + 1)
+    shift = 7 * (np.arange(raw.size) - starts[group])
+    deltas = np.bincount(group, weights=(raw & 0x7F).astype(np.float64) * np.exp2(shift))
+    return np.cumsum(deltas.astype(np.int64))
+
+
+def _contains_in_order(tokens: Sequence[str], segments: List[List[str]]) -> bool:
+    """Whether the segments occur in tokens contiguously each, in order, with any gap between them"""
+    position = 0
+    for segment in segments:
+        width = len(segment)
+        while position + width <= len(tokens) and list(tokens[position:position + width]) != segment:
+            position += 1
+        if position + width > len(tokens):
+            return False
+        position += width
+    return True
+
+
+class LatexNgramIndex:
+    """Token n-gram posting lists over formula content for substructure search.
+
+    Each formula's LaTeX tokens are indexed as overlapping n-grams. Posting lists
+    are delta + varint compressed byte strings of formula ids, so a pattern
+    like \\frac{\\partial ...}{\\partial t} only decodes the lists of its own
+    n-grams, and only the candidates sharing them are verified token by token.
+    The formula text itself is not kept: candidates are verified against the
+    text the caller looks up (the docstore, in the pipeline).
+    """
+
+    FNAME = "latex_ngram_index.bin"
+
+    def __init__(self, n: int = 3):
+        self.n = n
+        self.latex_processor = LatexSymbolsProcessor()
+        self._lock = threading.Lock()
+        self._postings: Dict[str, bytearray] = {}
+        # Last id appended per gram; ids only grow, so each append is one delta
+        self._last_ids: Dict[str, int] = {}
+        self._doc_ids: List[Optional[str]] = []
+        # Token count per formula id, for the shorter-is-more-specific tie break;
+        # grown by doubling, valid up to len(_doc_ids)
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._by_doc: Dict[str, int] = {}
+
+    @property
+    def num_formulas(self) -> int:
+        return len(self._by_doc)
+
+    def grams(self, tokens: Sequence[str]) -> List[str]:
+        """Distinct n-grams of a token sequence, space-joined"""
+        return list(dict.fromkeys(
+            " ".join(tokens[i:i + self.n]) for i in range(len(tokens) - self.n + 1)
+        ))
+
+    ###################################
+    #
+    # Index maintenance
+    #
+    ###################################
+
+    def formula_tokens(self, text: str) -> List[str]:
+        """Tokens of the formula a math node's text states, or [] if it states none"""
+        content = self.latex_processor.formula_content(text)
+        return tokenize_math(content) if content else []
+
+    def add_nodes(self, nodes: Iterable[Any]) -> None:
+        for node in nodes:
+            if node.metadata.get('type') != 'math':
+                continue
+            tokens = self.formula_tokens(node.text)
+            if not tokens:
+                continue
+            doc_id = node.ref_doc_id or node.node_id
+            with self._lock:
+                self._remove(doc_id)
+                self._add(doc_id, tokens)
+
+    def _add(self, doc_id: str, tokens: List[str]) -> None:
+        formula_id = len(self._doc_ids)
+        if formula_id == len(self._lengths):
+            lengths = np.zeros(max(16, 2 * formula_id), dtype=np.int32)
+            lengths[:formula_id] = self._lengths
+            self._lengths = lengths
+        self._doc_ids.append(doc_id)
+        self._lengths[formula_id] = len(tokens)
+        self._by_doc[doc_id] = formula_id
+        for gram in self.grams(tokens):
+            posting = self._postings.setdefault(gram, bytearray())
+            encode_varints([formula_id - self._last_ids.get(gram, 0)], posting)
+            self._last_ids[gram] = formula_id
+
+    def delete_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        with self._lock:
+            for doc_id in ref_doc_ids:
+                self._remove(doc_id)
+
+    def _remove(self, doc_id: str) -> None:
+        # Posting lists keep the id; it is filtered at query time and dropped on compaction
+        formula_id = self._by_doc.pop(doc_id, None)
+        if formula_id is not None:
+            self._doc_ids[formula_id] = None
+
+    def _compact(self) -> None:
+        """Renumber live formulas and re-encode the posting lists without deleted ids"""
+        live = np.asarray([doc_id is not None for doc_id in self._doc_ids], dtype=bool)
+        new_ids = np.cumsum(live) - 1
+        postings, last_ids = {}, {}
+        for gram, posting in self._postings.items():
+            ids = decode_postings(bytes(posting))
+            ids = new_ids[ids[live[ids]]]
+            if ids.size == 0:
+                continue
+            postings[gram] = bytearray()
+            encode_varints(np.diff(ids, prepend=0).tolist(), postings[gram])
+            last_ids[gram] = int(ids[-1])
+        self._postings, self._last_ids = postings, last_ids
+        self._lengths = self._lengths[:len(self._doc_ids)][live]
+        self._doc_ids = [doc_id for doc_id in self._doc_ids if doc_id is not None]
+        self._by_doc = {doc_id: i for i, doc_id in enumerate(self._doc_ids)}
+
+    ###################################
+    #
+    # Search
+    #
+    ###################################
+
+    def search(self, pattern: str, limit: int = 20, min_match: float = 1.0,
+               texts: Optional[Callable[[str], Optional[str]]] = None) -> List[Tuple[str, float]]:
+        """Formulas containing a LaTeX sub-expression, as (ref doc id, score) best first.
+
+        `pattern` may use "..." (or \\dots) for any run of tokens. Candidates must
+        share at least `min_match` of the pattern's n-grams; with the default 1.0
+        they must also contain every segment in order, checked on the formula
+        text `texts` returns for a ref doc id (without it, on n-grams alone).
+        The score is the fraction of pattern n-grams matched, ties going to
+        shorter (more specific) formulas. Raises PatternTooShortError if no
+        segment of the pattern has n tokens.
+        """
+        segments = [tokenize_math(part) for part in _WILDCARD.split(pattern)]
+        segments = [segment for segment in segments if segment]
+        pattern_grams = list(dict.fromkeys(g for segment in segments for g in self.grams(segment)))
+        if not pattern_grams:
+            raise PatternTooShortError(
+                f"Formula pattern {pattern!r} needs at least {self.n} LaTeX tokens between wildcards"
+            )
+
+        with self._lock:
+            lists = [decode_postings(bytes(self._postings.get(gram, b""))) for gram in pattern_grams]
+            ids, counts = np.unique(np.concatenate(lists), return_counts=True)
+            keep = counts >= min_match * len(pattern_grams)
+            ids, scores = ids[keep], counts[keep] / len(pattern_grams)
+            # Best candidates first, so verification stops as soon as `limit` formulas pass
+            order = np.lexsort((self._lengths[ids], -scores))
+            # Ids only ever get appended or blanked, so the list stays valid once the lock is released
+            doc_ids = self._doc_ids
+
+        verify = texts is not None and min_match >= 1.0
+        results = []
+        for i in order:
+            doc_id = doc_ids[int(ids[i])]
+            if doc_id is None:
+                continue
+            if verify and not _contains_in_order(self.formula_tokens(texts(doc_id) or ""), segments):
+                continue
+            results.append((doc_id, float(scores[i])))
+            if len(results) >= limit:
+                break
+        return results
+
+    ###################################
+    #
+    # Persistence
+    #
+    ###################################
+
+    def persist(self, persist_dir: str) -> None:
+        """Atomically write the index as a JSON header followed by the posting list bytes"""
+        with self._lock:
+            if len(self._doc_ids) > 2 * max(len(self._by_doc), 1):
+                self._compact()
+            grams = list(self._postings)
+            header = json.dumps({
+                "n": self.n,
+                "doc_ids": self._doc_ids,
+                "token_counts": self._lengths[:len(self._doc_ids)].tolist(),
+                "grams": grams,
+                "lengths": [len(self._postings[gram]) for gram in grams],
+                "last_ids": [self._last_ids[gram] for gram in grams],
+            }).encode("utf-8")
+            path = os.path.join(persist_dir, self.FNAME)
+            with open(path + ".tmp", "wb") as f:
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                for gram in grams:
+                    f.write(self._postings[gram])
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> Optional["LatexNgramIndex"]:
+        """Load a persisted index, or None if persist_dir has none"""
+        path = os.path.join(persist_dir, cls.FNAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size).decode("utf-8"))
+            blob = f.read()
+
+        index = cls(n=header["n"])
+        index._doc_ids = header["doc_ids"]
+        index._lengths = np.asarray(header["token_counts"], dtype=np.int32)
+        index._by_doc = {doc_id: i for i, doc_id in enumerate(index._doc_ids) if doc_id is not None}
+        offset = 0
+        for gram, length, last_id in zip(header["grams"], header["lengths"], header["last_ids"]):
+            index._postings[gram] = bytearray(blob[offset:offset + length])
+            index._last_ids[gram] = last_id
+            offset += length
+        logs.log.info(
+            f"Loaded LaTeX n-gram index over {index.num_formulas:,} formulas "
+            f"({len(blob):,} bytes of postings for {len(index._postings):,} n-grams)"
+        )
+        return index
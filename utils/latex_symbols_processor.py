@@ -1,6 +1,92 @@
-from typing import Dict, List, Set
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
 import re
 
+
+# Symbol vocabulary by category. Bit ids used by encode_symbols() follow this order,
+# so only ever append new names (or categories) to keep persisted masks valid.
+SYMBOL_VOCABULARY = {
+    'greek': ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta', 'iota', 'kappa',
+              'lambda', 'mu', 'nu', 'xi', 'pi', 'rho', 'sigma', 'tau', 'upsilon', 'phi', 'chi', 'psi',
+              'omega', 'Gamma', 'Delta', 'Theta', 'Lambda', 'Xi', 'Pi', 'Sigma', 'Upsilon', 'Phi',
+              'Psi', 'Omega'),
+    'operators': ('sum', 'prod', 'int', 'oint', 'bigcup', 'bigcap', 'bigoplus', 'bigotimes',
+                  'biguplus', 'bigsqcup'),
+    'relations': ('eq', 'neq', 'leq', 'geq', 'approx', 'sim', 'simeq', 'cong', 'equiv', 'prec',
+                  'succ', 'subset', 'supset', 'subseteq', 'supseteq', 'in', 'ni', 'notin'),
+    'delimiters': ('left', 'right', 'langle', 'rangle', 'lfloor', 'rfloor', 'lceil', 'rceil',
+                   'lbrace', 'rbrace', 'lbrack', 'rbrack', 'vert', 'Vert'),
+    'functions': ('sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'arcsin', 'arccos', 'arctan', 'sinh',
+                  'cosh', 'tanh', 'log', 'ln', 'exp', 'lim', 'sup', 'inf', 'max', 'min'),
+    'calculus': ('nabla', 'partial', 'infty'),
+}
+
+# (category, command) for each bit, and the reverse lookup
+_SYMBOL_BITS = [
+    (category, '\\' + name)
+    for category, names in SYMBOL_VOCABULARY.items()
+    for name in names
+]
+_SYMBOL_IDS = {symbol: bit for bit, (_, symbol) in enumerate(_SYMBOL_BITS)}
+
+
+def encode_symbols(categories: Dict[str, list]) -> int:
+    """Pack a categorize_symbols() result into an int bitset over SYMBOL_VOCABULARY"""
+    mask = 0
+    for symbols in categories.values():
+        for symbol in symbols:
+            bit = _SYMBOL_IDS.get(symbol)
+            if bit is not None:
+                mask |= 1 << bit
+    return mask
+
+
+def decode_symbols(mask: int) -> Dict[str, list]:
+    """Unpack an encode_symbols() bitset into category -> symbols (in vocabulary order)"""
+    categories = {category: [] for category in SYMBOL_VOCABULARY}
+    bit = 0
+    while mask:
+        if mask & 1:
+            category, symbol = _SYMBOL_BITS[bit]
+            categories[category].append(symbol)
+        mask >>= 1
+        bit += 1
+    return categories
+
+
+# Layout-only commands that do not change what a formula says
+LAYOUT_COMMANDS = frozenset({
+    '\\left', '\\right', '\\displaystyle', '\\textstyle', '\\quad', '\\qquad',
+    '\\,', '\\;', '\\:', '\\!', '\\ ', '\\nonumber', '\\notag',
+})
+_MATH_TOKEN = re.compile(r"\\[A-Za-z]+|\\.|[A-Za-z]|\d+(?:\.\d+)?|\S")
+
+
+def tokenize_math(latex: str) -> List[str]:
+    """Split LaTeX math into command, letter, number and punctuation tokens, dropping layout commands"""
+    return [token for token in _MATH_TOKEN.findall(latex) if token not in LAYOUT_COMMANDS]
+
+
+@lru_cache(maxsize=None)
+def _compile_symbol_pattern(categories: Tuple[Tuple[str, str], ...]) -> "re.Pattern":
+    """One named-group alternation over every category; a command must not continue with a letter"""
+    alternatives = "|".join(f"(?P<{category}>{pattern})" for category, pattern in categories)
+    return re.compile(rf"(?:{alternatives})(?![A-Za-z])")
+
+
+@lru_cache(maxsize=None)
+def _compile_math_scanner(environments: Tuple[str, ...]) -> "re.Pattern":
+    """One alternation matching $$...$$, \\begin{env}...\\end{env} and $...$ in a single pass"""
+    env_names = "|".join(re.escape(env) for env in sorted(environments, key=len, reverse=True))
+    return re.compile(
+        r"\$\$(?P<display>.*?)\$\$"
+        rf"|\\begin\{{(?P<env>{env_names})\}}(?P<env_content>(?s:.*?))\\end\{{(?P=env)\}}"
+        # Inline math stops at an environment boundary and never takes one half of a
+        # $$ pair, so a stray $ (a price, say) cannot swallow the blocks after it
+        r"|\$(?!\$)(?P<inline>(?:(?!\\(?:begin|end)\{)[^$\n])*?)\$(?!\$)"
+    )
+
+
 class LatexSymbolsProcessor:
     def __init__(self):
         # Common LaTeX math environments
@@ -11,66 +97,59 @@ class LatexSymbolsProcessor:
         
         # Initialize symbol mappings
         self.symbol_categories = {
-            'greek': r'\\(?:alpha|beta|gamma|delta|epsilon|zeta|eta|theta|iota|kappa|lambda|mu|nu|xi|pi|rho|sigma|tau|upsilon|phi|chi|psi|omega|Gamma|Delta|Theta|Lambda|Xi|Pi|Sigma|Upsilon|Phi|Psi|Omega)',
-            'operators': r'\\(?:sum|prod|int|oint|bigcup|bigcap|bigoplus|bigotimes|biguplus|bigsqcup)',
-            'relations': r'\\(?:eq|neq|leq|geq|approx|sim|simeq|cong|equiv|prec|succ|subset|supset|subseteq|supseteq|in|ni|notin)',
-            'delimiters': r'\\(?:left|right|langle|rangle|lfloor|rfloor|lceil|rceil|lbrace|rbrace|lbrack|rbrack|vert|Vert)',
-            'functions': r'\\(?:sin|cos|tan|cot|sec|csc|arcsin|arccos|arctan|sinh|cosh|tanh|log|ln|exp|lim|sup|inf|max|min)'
+            category: r'\\(?:' + '|'.join(names) + ')'
+            for category, names in SYMBOL_VOCABULARY.items()
         }
+        
+        # Expressions are categorized several times per math environment during ingestion
+        self._categorize_cached = lru_cache(maxsize=65536)(self._categorize)
 
     def extract_math_environments(self, text: str) -> List[Dict[str, str]]:
-        """Extract mathematical environments and their contents"""
+        """Extract mathematical environments and their contents.
+
+        A single precompiled scanner returns non-overlapping matches in text order,
+        with their character span in 'start'/'end'.
+        """
+        scanner = _compile_math_scanner(tuple(self.math_environments))
         environments = []
-        
-        # Pattern for all math environments
-        for env in self.math_environments:
-            pattern = rf"\\begin\{{{env}\}}(.*?)\\end\{{{env}\}}"
-            matches = re.finditer(pattern, text, re.DOTALL)
-            for match in matches:
-                environments.append({
-                    'type': env,
-                    'content': match.group(1),
-                    'full': match.group(0)
-                })
-        
-        # Extract inline math $...$ and display math $$...$$
-        inline_pattern = r'\$(.*?)\$'
-        display_pattern = r'\$\$(.*?)\$\$'
-        
-        for match in re.finditer(inline_pattern, text):
-            if not text[match.start()-2:match.start()].endswith('$$'):
-                environments.append({
-                    'type': 'inline',
-                    'content': match.group(1),
-                    'full': match.group(0)
-                })
-                
-        for match in re.finditer(display_pattern, text):
+        for match in scanner.finditer(text):
+            display, env, env_content, inline = match.groups()
+            start, end = match.span()
+            if env is not None:
+                env_type, content = env, env_content
+            elif display is not None:
+                env_type, content = 'display', display
+            else:
+                env_type, content = 'inline', inline
             environments.append({
-                'type': 'display',
-                'content': match.group(1),
-                'full': match.group(0)
+                'type': env_type,
+                'content': content,
+                'full': text[start:end],
+                'start': start,
+                'end': end
             })
-        
         return environments
+
+    def formula_content(self, text: str) -> Optional[str]:
+        """Content of the single math environment making up text, or None if text is anything else"""
+        text = text.strip()
+        environments = self.extract_math_environments(text)
+        if len(environments) != 1 or environments[0]['full'] != text:
+            return None
+        return environments[0]['content']
+
     def categorize_symbols(self, latex: str) -> Dict[str, list]:
-        """Categorize LaTeX symbols in the text"""
-        # Initialize with lists instead of sets
-        categories = {cat: [] for cat in self.symbol_categories.keys()}
-        
-        for category, pattern in self.symbol_categories.items():
-            matches = re.finditer(pattern, latex)
-            # Convert to list and remove duplicates while preserving order
-            symbols = []
-            seen = set()
-            for match in matches:
-                symbol = match.group(0)
-                if symbol not in seen:
-                    symbols.append(symbol)
-                    seen.add(symbol)
-            categories[category] = symbols
-        
-        return categories
+        """Categorize LaTeX symbols in the text (one regex pass, memoized per expression)"""
+        # Fresh lists so callers can't mutate the memoized result
+        return {category: list(symbols) for category, symbols in self._categorize_cached(latex)}
+
+    def _categorize(self, latex: str) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+        pattern = _compile_symbol_pattern(tuple(self.symbol_categories.items()))
+        # Remove duplicates while preserving order of first appearance
+        categories = {category: {} for category in self.symbol_categories}
+        for match in pattern.finditer(latex):
+            categories[match.lastgroup][match.group(0)] = None
+        return tuple((category, tuple(symbols)) for category, symbols in categories.items())
 
     def normalize_math_expression(self, expr: str) -> str:
         """Normalize mathematical expressions for consistent processing"""
@@ -0,0 +1,119 @@
+import re
+from typing import Any, Callable, List, Tuple
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser.interface import MetadataAwareTextSplitter
+from llama_index.core.utils import get_tokenizer
+
+from utils.latex_symbols_processor import LatexSymbolsProcessor
+
+# A sentence runs to terminal punctuation followed by whitespace, a blank line or the end of the text
+_SENTENCE = re.compile(r"\S.*?(?:[.!?](?=\s)|\n\s*\n|$)", re.DOTALL)
+_WORD = re.compile(r"\S+")
+
+# However long the metadata is, leave text this many tokens, or a quarter of
+# chunk_size if that is less (so small chunk sizes still fit their budget)
+_MIN_BUDGET = 64
+
+
+class MathAwareNodeParser(MetadataAwareTextSplitter):
+    """Token-budgeted chunker that keeps every math environment in one piece.
+
+    Text is packed sentence by sentence (words for over-long sentences) into
+    chunks of at most `chunk_size` tokens, counting the node's metadata, with
+    about `chunk_overlap` tokens of text repeated between consecutive chunks.
+    Math spans ($...$, $$...$$, \\begin{align}...\\end{align}, ...) are atomic:
+    they are never cut, and one longer than the budget becomes its own chunk.
+    Every chunk is a contiguous span of the source text.
+    """
+
+    chunk_size: int = Field(default=1024, gt=0, description="Token budget per chunk, metadata included")
+    chunk_overlap: int = Field(default=200, ge=0, description="Tokens of text repeated between chunks")
+
+    _tokenizer: Callable = PrivateAttr()
+    _latex_processor: LatexSymbolsProcessor = PrivateAttr()
+
+    def __init__(self, chunk_size: int = 1024, chunk_overlap: int = 200, **kwargs: Any):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, **kwargs)
+        self._tokenizer = get_tokenizer()
+        self._latex_processor = LatexSymbolsProcessor()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MathAwareNodeParser"
+
+    def split_text(self, text: str) -> List[str]:
+        return self.split_text_metadata_aware(text, metadata_str="")
+
+    def split_text_metadata_aware(self, text: str, metadata_str: str) -> List[str]:
+        budget = self.chunk_size
+        if metadata_str:
+            budget = max(budget - self._count(metadata_str), min(_MIN_BUDGET, max(1, self.chunk_size // 4)))
+        return [text[start:end] for start, end in self._chunk_spans(text, budget)]
+
+    def _count(self, text: str) -> int:
+        return len(self._tokenizer(text))
+
+    def _units(self, text: str, budget: int) -> List[Tuple[int, int, int, bool]]:
+        """(start, end, tokens, is_math) pieces of text in order, math spans kept whole"""
+        units = []
+        cursor = 0
+        for env in self._latex_processor.extract_math_environments(text):
+            units.extend(self._text_units(text, cursor, env['start'], budget))
+            units.append((env['start'], env['end'], self._count(env['full']), True))
+            cursor = env['end']
+        units.extend(self._text_units(text, cursor, len(text), budget))
+        return units
+
+    def _text_units(self, text: str, start: int, end: int, budget: int) -> List[Tuple[int, int, int, bool]]:
+        units = []
+        for sentence in _SENTENCE.finditer(text, start, end):
+            tokens = self._count(sentence.group())
+            if tokens <= budget:
+                units.append((sentence.start(), sentence.end(), tokens, False))
+                continue
+            # Over-long sentence: fall back to windows of whole words
+            window_start = window_end = None
+            window_tokens = 0
+            for word in _WORD.finditer(text, sentence.start(), sentence.end()):
+                word_tokens = self._count(word.group())
+                if window_start is not None and window_tokens + word_tokens > budget:
+                    units.append((window_start, window_end, window_tokens, False))
+                    window_start = None
+                if window_start is None:
+                    window_start, window_tokens = word.start(), 0
+                window_end = word.end()
+                window_tokens += word_tokens
+            if window_start is not None:
+                units.append((window_start, window_end, window_tokens, False))
+        return units
+
+    def _chunk_spans(self, text: str, budget: int) -> List[Tuple[int, int]]:
+        """Greedily pack units into (start, end) spans of at most `budget` tokens"""
+        spans = []
+        current: List[Tuple[int, int, int, bool]] = []
+        current_tokens = 0
+        for unit in self._units(text, budget):
+            if current and current_tokens + unit[2] > budget:
+                spans.append((current[0][0], current[-1][1]))
+                current = self._overlap(current, budget - unit[2])
+                current_tokens = sum(u[2] for u in current)
+            current.append(unit)
+            current_tokens += unit[2]
+        if current:
+            spans.append((current[0][0], current[-1][1]))
+        return spans
+
+    def _overlap(self, units: List[Tuple[int, int, int, bool]], room: int) -> List[Tuple[int, int, int, bool]]:
+        """Trailing text units of a finished chunk to repeat at the start of the next one"""
+        tail = []
+        tokens = 0
+        for unit in reversed(units):
+            # Equations are not repeated; overlap only carries surrounding prose
+            if unit[3] or tokens + unit[2] > min(self.chunk_overlap, room):
+                break
+            tail.insert(0, unit)
+            tokens += unit[2]
+        return tail
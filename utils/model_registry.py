@@ -0,0 +1,187 @@
+import threading
+from typing import Dict, Tuple
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.llms.ollama import Ollama
+
+from utils import logs
+from utils.embedding_cache import CachedEmbedding, EmbeddingCache
+
+DEFAULT_LLM_MODEL = "llama2:7b"
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+DEFAULT_EMBEDDING_MODEL = "BAAI/bge-large-en-v1.5"
+DEFAULT_STORAGE_DIR = "indexes"
+DEFAULT_EMBEDDING_CACHE = "cache/embeddings.sqlite"
+# Tokens Ollama keeps in context (num_ctx); llama-index packs prompts to the same size
+LLM_CONTEXT_WINDOW = 2048
+
+# Process-wide handles. Every caller (FastAPI, Streamlit reruns, rag.rag_pipeline)
+# goes through these so each model and index is only loaded once per process.
+_lock = threading.RLock()
+_llms: Dict[Tuple[str, str], Ollama] = {}
+_embedding_models: Dict[Tuple[str, bool], BaseEmbedding] = {}
+_embedding_caches: Dict[str, EmbeddingCache] = {}
+_pipelines: Dict[str, "RagPipeline"] = {}
+
+
+###################################
+#
+# Shared LLM
+#
+###################################
+
+
+def get_llm(model: str = DEFAULT_LLM_MODEL, base_url: str = DEFAULT_OLLAMA_URL) -> Ollama:
+    """
+    Returns the shared Ollama LLM wrapper for a model, creating it on first use.
+
+    Args:
+        model (str): The Ollama model name. Defaults to llama2:7b.
+        base_url (str): The Ollama endpoint. Defaults to http://localhost:11434.
+
+    Returns:
+        Ollama: The process-wide LLM instance for this model and endpoint.
+    """
+    key = (model, base_url)
+    with _lock:
+        if key not in _llms:
+            _llms[key] = Ollama(
+                model=model,
+                base_url=base_url,
+                request_timeout=60.0,
+                context_window=LLM_CONTEXT_WINDOW,
+                additional_kwargs={
+                    "num_ctx": LLM_CONTEXT_WINDOW,
+                    "num_thread": 4
+                }
+            )
+            logs.log.info(f"Created shared LLM {model} at {base_url}")
+        return _llms[key]
+
+
+###################################
+#
+# Shared Embedding Model
+#
+###################################
+
+
+def get_embedding_model(
+    model_name: str = DEFAULT_EMBEDDING_MODEL,
+    use_cache: bool = True,
+) -> BaseEmbedding:
+    """
+    Returns the shared Hugging Face embedding model, loading it on first use.
+
+    Args:
+        model_name (str): The Hugging Face model to load. Defaults to BAAI/bge-large-en-v1.5.
+        use_cache (bool): Wrap the model with the on-disk embedding cache. Defaults to True.
+
+    Returns:
+        BaseEmbedding: The process-wide embedding model.
+    """
+    # Imported on first use: pulling in sentence-transformers/torch dominates startup time
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    from llama_index.embeddings.huggingface.utils import (
+        get_query_instruct_for_model_name,
+        get_text_instruct_for_model_name,
+    )
+
+    key = (model_name, use_cache)
+    with _lock:
+        if key not in _embedding_models:
+            embedding_model = HuggingFaceEmbedding(
+                model_name=model_name,
+                cache_folder="./models",
+                max_length=512,
+                embed_batch_size=4
+            )
+            if use_cache:
+                # A query embedding is the text embedding of instruction + query only
+                # when passages are embedded without an instruction of their own
+                query_instruction = None
+                if not get_text_instruct_for_model_name(model_name):
+                    query_instruction = get_query_instruct_for_model_name(model_name)
+                embedding_model = CachedEmbedding(
+                    embedding_model, get_embedding_cache(), query_instruction=query_instruction
+                )
+            _embedding_models[key] = embedding_model
+            logs.log.info(f"Loaded shared embedding model {model_name}")
+        return _embedding_models[key]
+
+
+def get_embedding_cache(path: str = DEFAULT_EMBEDDING_CACHE) -> EmbeddingCache:
+    """
+    Returns the shared on-disk embedding cache.
+
+    Args:
+        path (str): SQLite file backing the cache. Defaults to cache/embeddings.sqlite.
+
+    Returns:
+        EmbeddingCache: The process-wide cache for this path.
+    """
+    with _lock:
+        if path not in _embedding_caches:
+            _embedding_caches[path] = EmbeddingCache(path)
+        return _embedding_caches[path]
+
+
+###################################
+#
+# Shared Pipeline
+#
+###################################
+
+
+def get_pipeline(
+    storage_dir: str = DEFAULT_STORAGE_DIR,
+    math_processor=None,
+    symbolic_processor=None,
+    lazy: bool = False,
+) -> "RagPipeline":
+    """
+    Returns the shared RagPipeline for a storage directory, building it on first use.
+
+    Args:
+        storage_dir (str): Directory holding the persisted index. Defaults to "indexes".
+        math_processor (MathProcessor, optional): Used only when the pipeline is first built.
+        symbolic_processor (SymbolicProcessor, optional): Used only when the pipeline is first built.
+        lazy (bool): Defer loading models and index until first use. Used only when the pipeline is first built.
+
+    Returns:
+        RagPipeline: The pipeline shared by every caller in this process.
+    """
+    # Imported here to avoid a circular import with utils.rag_pipeline
+    from utils.math_processor import MathProcessor
+    from utils.symbolic_processor import SymbolicProcessor
+    from utils.rag_pipeline import RagPipeline
+
+    with _lock:
+        if storage_dir not in _pipelines:
+            _pipelines[storage_dir] = RagPipeline(
+                math_processor or MathProcessor(),
+                symbolic_processor or SymbolicProcessor(),
+                storage_dir=storage_dir,
+                lazy=lazy,
+                persist_response_cache=True
+            )
+        return _pipelines[storage_dir]
+
+
+def clear(pipelines_only: bool = False) -> None:
+    """
+    Drops shared handles so the next request rebuilds them.
+
+    Args:
+        pipelines_only (bool): Keep the loaded models and only forget pipelines. Defaults to False.
+    """
+    with _lock:
+        for pipeline in _pipelines.values():
+            pipeline.close()
+        _pipelines.clear()
+        if not pipelines_only:
+            _llms.clear()
+            _embedding_models.clear()
+            for cache in _embedding_caches.values():
+                cache.close()
+            _embedding_caches.clear()
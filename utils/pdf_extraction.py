@@ -0,0 +1,97 @@
+from typing import Any, Dict, Iterator, List, Optional
+
+from pypdf import PdfReader
+
+from utils import logs
+from utils.latex_symbols_processor import LatexSymbolsProcessor, encode_symbols
+
+# Page extraction kept free of llama-index so the process-pool workers that run
+# extract_page_range start in a fraction of a second. Pages come back as plain
+# {'text', 'metadata'} records; the pipeline turns them into Documents.
+
+
+def build_page_records(latex_processor: LatexSymbolsProcessor, text: str, page_num: int,
+                       compact_symbols: bool = False) -> List[Dict[str, Any]]:
+    """Split one page's text into interleaved text and math records.
+
+    A single linear pass over the math spans; every record's metadata has
+    'char_start'/'char_end' offsets into the page text. Math records carry
+    their symbols as an int bitset in 'symbols_mask' (see decode_symbols) and,
+    unless compact_symbols is set, as per-category lists in 'symbols'.
+    """
+    records = []
+    cursor = 0
+
+    for env in latex_processor.extract_math_environments(text):
+        # Text between the previous span and this one
+        text_record = _text_record(text, cursor, env['start'], page_num)
+        if text_record is not None:
+            records.append(text_record)
+
+        searchable_text = latex_processor.create_searchable_text(env)
+
+        # Get symbols and ensure they're JSON serializable
+        symbols = latex_processor.categorize_symbols(env['content'])
+
+        metadata = {
+            'type': 'math',
+            'math_type': env['type'],
+            'page': page_num + 1,
+            'char_start': env['start'],
+            'char_end': env['end'],
+            'searchable_text': searchable_text,
+            'symbols_mask': encode_symbols(symbols)
+        }
+        if not compact_symbols:
+            metadata['symbols'] = symbols  # Now contains lists instead of sets
+
+        records.append({
+            'text': env['full'],  # Original LaTeX
+            'metadata': metadata
+        })
+        cursor = env['end']
+
+    text_record = _text_record(text, cursor, len(text), page_num)
+    if text_record is not None:
+        records.append(text_record)
+
+    return records
+
+
+def _text_record(text: str, start: int, end: int, page_num: int) -> Optional[Dict[str, Any]]:
+    """Text record for text[start:end] with surrounding whitespace trimmed, or None if blank"""
+    segment = text[start:end]
+    stripped = segment.strip()
+    if not stripped:
+        return None
+    char_start = start + len(segment) - len(segment.lstrip())
+    return {
+        'text': stripped,
+        'metadata': {
+            'type': 'text',
+            'page': page_num + 1,
+            'char_start': char_start,
+            'char_end': char_start + len(stripped)
+        }
+    }
+
+
+def iter_page_records(reader: PdfReader, start: int, stop: int,
+                      latex_processor: Optional[LatexSymbolsProcessor] = None,
+                      compact_symbols: bool = False) -> Iterator[Dict[str, Any]]:
+    """Yield records for pages [start, stop) of an open PDF, skipping pages that fail"""
+    latex_processor = latex_processor or LatexSymbolsProcessor()
+    for page_num in range(start, stop):
+        try:
+            text = reader.pages[page_num].extract_text()
+            records = build_page_records(latex_processor, text, page_num, compact_symbols)
+        except Exception as e:
+            logs.log.warning(f"Error processing page {page_num + 1}: {str(e)}")
+            continue
+        yield from records
+
+
+def extract_page_range(file_path: str, start: int, stop: int,
+                       compact_symbols: bool = False) -> List[Dict[str, Any]]:
+    """Extract records for pages [start, stop) of a PDF; runs in worker processes"""
+    return list(iter_page_records(PdfReader(file_path), start, stop, compact_symbols=compact_symbols))
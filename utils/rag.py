@@ -1,12 +1,11 @@
+import asyncio
 import os
 from pathlib import Path
 from typing import List, Any, Optional
 import shutil
 
 from utils import logs
-from utils.math_processor import MathProcessor
-from utils.symbolic_processor import SymbolicProcessor
-from utils.rag_pipeline import RagPipeline
+from utils import model_registry
 
 def rag_pipeline(uploaded_files=None):
     """
@@ -19,18 +18,13 @@ def rag_pipeline(uploaded_files=None):
         error: Any error that occurred during processing, or None if successful.
     """
     try:
-        # Initialize processors and pipeline
-        math_processor = MathProcessor()
-        symbolic_processor = SymbolicProcessor()
-        rag_pipeline = RagPipeline(math_processor, symbolic_processor)
+        # Reuse the process-wide pipeline instead of reloading the models
+        rag_pipeline = model_registry.get_pipeline("indexes")
         
         # Create necessary directories
         os.makedirs("pdfs", exist_ok=True)
         os.makedirs("indexes", exist_ok=True)
         
-        # Update storage directory to use indexes folder
-        rag_pipeline.storage_dir = "indexes"
-        
         # If files were provided, process them
         if uploaded_files:
             # Copy uploaded files to pdfs directory first
@@ -54,4 +48,31 @@ def rag_pipeline(uploaded_files=None):
         return None  # No errors
     except Exception as e:
         logs.log.error(f"Error in RAG pipeline: {e}")
-        return e  # Return the error 
\ No newline at end of file
+        return e  # Return the error 
+
+
+async def arag_pipeline(file_paths: List[str]):
+    """
+    Async ingestion for the API server.
+
+    Ingestion runs in a worker thread, so the event loop keeps answering
+    queries while documents are embedded and indexed.
+
+    Args:
+        file_paths (list): Paths of the uploaded files, already saved to disk (PDFs in 'pdfs').
+
+    Returns:
+        error: Any error that occurred during processing, or None if successful.
+    """
+    def process():
+        try:
+            rag_pipeline = model_registry.get_pipeline("indexes")
+            os.makedirs("indexes", exist_ok=True)
+            rag_pipeline.process_paths(file_paths)
+            logs.log.info("Documents processed successfully")
+            return None
+        except Exception as e:
+            logs.log.error(f"Error in RAG pipeline: {e}")
+            return e
+
+    return await asyncio.to_thread(process)
@@ -1,38 +1,194 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Set
+import asyncio
 import logging
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict, deque
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from pathlib import Path
 import os
 import json
-from tenacity import retry, stop_after_attempt, wait_exponential
+import re
+from tenacity import (
+    retry, retry_if_exception_type, retry_if_not_exception_type, stop_after_attempt, wait_exponential
+)
 import httpx
 from tqdm import tqdm
 from llama_index.core import (
     VectorStoreIndex,
     Document,
-    ServiceContext,
     Settings,
     StorageContext,
     load_index_from_storage
 )
-from llama_index.llms.ollama import Ollama
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.indices.prompt_helper import PromptHelper
+from llama_index.core.prompts.prompt_utils import get_biggest_prompt
+from llama_index.core.response_synthesizers.refine import DEFAULT_RESPONSE_PADDING_SIZE
+from llama_index.core.query_engine import RetrieverQueryEngine
 from utils import logs
+from utils import model_registry
 from utils.math_processor import MathProcessor
 from utils.symbolic_processor import SymbolicProcessor
 from utils.latex_symbols_processor import LatexSymbolsProcessor
+from utils.vector_store import MemmapVectorStore
+from utils.symbol_index import SymbolIndex
+from utils.bm25_index import BM25Index
+from utils.hybrid_retriever import HybridRetriever
+from utils.formula_index import FormulaIndex
+from utils.latex_ngram_index import LatexNgramIndex
+from utils.math_node_parser import MathAwareNodeParser
+from utils.response_cache import ResponseCache, SemanticCache
+from utils.pdf_extraction import extract_page_range, iter_page_records
 from pypdf import PdfReader
-from tenacity import retry, stop_after_attempt, wait_exponential
+
+# Below this many pages a PDF is extracted in-process even with pdf_workers > 1.
+# Dense math pages take ~20 ms each to extract, and shipping their records back
+# from a warm pool costs about half that, so short papers gain nothing
+PARALLEL_MIN_PAGES = 32
+
+# Marks the end of the document stream on the ingestion queue
+_END_OF_STREAM = object()
+
+# File in storage_dir recording the version stamp of the persisted index
+INDEX_STAMP_FNAME = "index_stamp"
+
+# Lexical indexes kept in sync with the vector index and persisted next to it,
+# by RagPipeline attribute name
+SIDE_INDEXES = {
+    'symbol_index': SymbolIndex,
+    'bm25_index': BM25Index,
+    'formula_index': FormulaIndex,
+    'latex_ngram_index': LatexNgramIndex,
+}
+
+# Where each metadata field is shown: "both" (embedded text and LLM prompt), "embed",
+# "llm" or "store" (kept on the node only). Unlisted fields default to "both".
+METADATA_VISIBILITY = {
+    'type': 'both',
+    'math_type': 'both',
+    'page': 'both',
+    'file_path': 'llm',
+    'file_name': 'llm',
+    'searchable_text': 'embed',
+    'symbols': 'store',
+    'symbols_mask': 'store',
+    'char_start': 'store',
+    'char_end': 'store',
+    'math_expressions': 'store',
+    'math_expression_count': 'store',
+}
+
+# Retrieval modes accepted by RagPipeline.query
+RETRIEVAL_MODES = ("vector", "hybrid")
+
+# Questions longer than this many characters are answered in chunks
+LONG_QUESTION_CHARS = 1000
+
+# Most threads one long question retrieves with at once, however many chunks it has
+CHUNK_THREADS = 8
+
+# How RagPipeline.query answers a long question: one LLM call per chunk ("concurrent")
+# or one call over the merged, de-duplicated context of all chunks ("merge")
+CHUNK_MODES = ("concurrent", "merge")
+
+# Retry a query only when the LLM server could not be reached or dropped the connection
+# (the ollama client reports a refused connection as ConnectionError); timeouts raise
+# at once so query_timeout stays a deadline
+QUERY_RETRY = dict(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=(retry_if_exception_type((httpx.TransportError, ConnectionError))
+           & retry_if_not_exception_type(httpx.TimeoutException)),
+    reraise=True
+)
+
+SYSTEM_PROMPT = """You are a mathematical assistant specialized in LaTeX and mathematical concepts.
+When responding:
+1. Always use proper LaTeX notation for mathematical expressions
+2. Provide step-by-step explanations for mathematical problems
+3. Include relevant mathematical theorems or definitions
+4. Format complex equations using display math mode ($$...$$)
+5. Use appropriate mathematical symbols and notations"""
 
 
 class RagPipeline:
-   def __init__(self, math_processor: MathProcessor, symbolic_processor: SymbolicProcessor):
+   def __init__(self, math_processor: MathProcessor, symbolic_processor: SymbolicProcessor,
+                storage_dir: str = "indexes", lazy: bool = False, vector_dtype: str = "float32",
+                pdf_workers: Optional[int] = None, compact_symbols: bool = False,
+                formula_sympy: bool = False, metadata_visibility: Optional[Dict[str, str]] = None,
+                chunk_size: int = 1024, chunk_overlap: int = 200,
+                persist_response_cache: bool = False, semantic_cache: bool = False):
         self.math_processor = math_processor
         self.symbolic_processor = symbolic_processor
         self.latex_processor = LatexSymbolsProcessor()
-        self.index = None
-        self.llm = None
-        self.embedding_model = None
-        self.storage_dir = "indexes"
+        self._index = None
+        self._llm = None
+        self._embedding_model = None
+        self._index_loaded = False
+        self.symbol_index = None
+        self.bm25_index = None
+        self.formula_index = None
+        self.latex_ngram_index = None
+        self._init_lock = threading.RLock()
+        self._ingest_lock = threading.Lock()
+        # Query engines reused across queries, keyed by configuration and index version
+        self._index_version = 0
+        # Changes with the index contents only and is persisted with it, so
+        # cached answers survive restarts but never outlive the index they came from
+        self._index_stamp = uuid.uuid4().hex
+        self._query_engines = OrderedDict()
+        self._query_engines_lock = threading.Lock()
+        self.query_engine_cache_size = 16
+        # Long questions: chunk LLM calls allowed in flight at once, and the
+        # deadline in seconds for the whole question
+        self.chunk_concurrency = 4
+        self.query_timeout = 300.0
+        # Optional cap on the context tokens (metadata included) sent to the single LLM
+        # call of chunk_mode="merge"; None uses whatever the LLM context window leaves
+        self.merge_context_tokens = None
+        # Answers to repeated questions, kept next to the index when persisted
+        self.response_cache = ResponseCache(
+            path=os.path.join(storage_dir, ResponseCache.FNAME) if persist_response_cache else None
+        )
+        # Answers reused for paraphrased questions. Opt-in: embeddings blur small
+        # differences in the math (x^2 vs x^3), so such hits are only mostly right
+        self.semantic_cache = SemanticCache() if semantic_cache else None
+        self.lazy = lazy
+        self.storage_dir = storage_dir
+        # float16 halves the on-disk and mapped size of the vectors at a small precision cost
+        self.vector_dtype = vector_dtype
+        # Processes used for PDF page extraction; 1 (the default) extracts in this process.
+        # The pool is started by the first large PDF and reused until close()
+        self.pdf_workers = pdf_workers or 1
+        self._pdf_pool = None
+        self._pdf_pool_workers = 0
+        self._pdf_pool_lock = threading.Lock()
+        # Keep only the 'symbols_mask' bitset on math nodes, dropping the per-category lists
+        self.compact_symbols = compact_symbols
+        # Canonicalize formulas with SymPy for a new formula index (slower, also equates reorderings)
+        self.formula_sympy = formula_sympy
+        # Per-field overrides of METADATA_VISIBILITY
+        self.metadata_visibility = {**METADATA_VISIBILITY, **(metadata_visibility or {})}
+        self._metadata_token_savings = {'nodes': 0, 'embed': 0, 'llm': 0}
+        # Splits documents into nodes without ever cutting an equation
+        self.node_parser = MathAwareNodeParser(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        # Streaming ingestion: documents per embed/insert batch, batches buffered
+        # between extraction and embedding, and documents between intermediate persists
+        self.ingest_batch_size = 64
+        self.ingest_queue_size = 4
+        self.persist_every = 2048
+        if lazy:
+            # Models and index are materialized by the properties below on first use
+            logs.log.info("RAG pipeline created in lazy mode")
+            return
         print("Initializing RAG Pipeline...")
         with tqdm(total=3, desc="Setup Progress") as pbar:
             self.setup_models()
@@ -42,6 +198,74 @@ class RagPipeline:
             logs.log.info("RAG pipeline initialized")
             pbar.update(1)
 
+   @property
+   def llm(self):
+       """Ollama LLM wrapper, created on first access in lazy mode"""
+       if self._llm is None and self.lazy:
+           with self._init_lock:
+               if self._llm is None:
+                   self._setup_llm()
+       return self._llm
+
+   @llm.setter
+   def llm(self, value):
+       self._llm = value
+       self._invalidate_query_engines(index_changed=False)
+
+   @property
+   def embedding_model(self):
+       """Embedding model, loaded on first access in lazy mode"""
+       if self._embedding_model is None and self.lazy:
+           with self._init_lock:
+               if self._embedding_model is None:
+                   self._setup_embedding_model()
+       return self._embedding_model
+
+   @embedding_model.setter
+   def embedding_model(self, value):
+       self._embedding_model = value
+
+   @property
+   def index(self):
+       """Vector index, loaded from storage on first access in lazy mode"""
+       if not self._index_loaded and self.lazy:
+           with self._init_lock:
+               if not self._index_loaded:
+                   self.load_existing_index()
+       return self._index
+
+   @index.setter
+   def index(self, value):
+       self._index = value
+       self._index_loaded = True
+       self._invalidate_query_engines()
+
+   def status(self) -> Dict[str, bool]:
+       """Report which components are materialized, without loading anything"""
+       return {
+           'llm_loaded': self._llm is not None,
+           'embedding_model_loaded': self._embedding_model is not None,
+           'index_loaded': self._index is not None
+       }
+
+   def warm_up(self, background: bool = True) -> Optional[threading.Thread]:
+       """Materialize the models and index ahead of the first request"""
+       def _load():
+           try:
+               self.embedding_model
+               self.llm
+               self.index
+               logs.log.info("RAG pipeline warm-up complete")
+           except Exception as e:
+               logs.log.warning(f"RAG pipeline warm-up failed: {e}")
+
+       if not background:
+           _load()
+           return None
+       thread = threading.Thread(target=_load, name="rag-warm-up", daemon=True)
+       thread.start()
+       return thread
+
    def setup_models(self):
         """Initialize LLM and embedding models"""
         try:
@@ -50,101 +274,172 @@ class RagPipeline:
                 warnings.filterwarnings('ignore', category=UserWarning)
                 pbar.update(1)
                 
-                # Increase timeout and add threading
-                self.llm = Ollama(
-                    model="llama2:7b",
-                    base_url="http://localhost:11434",
-                    request_timeout=60.0,  # 3 minutes
-                    additional_kwargs={
-                        "num_ctx": 2048,
-                        "num_thread": 4
-                    }
-                )
-                Settings.llm = self.llm
+                self._setup_llm()
                 pbar.update(1)
                 
-                self.embedding_model = HuggingFaceEmbedding(
-                    model_name="BAAI/bge-large-en-v1.5",
-                    cache_folder="./models",
-                    max_length=512,
-                    embed_batch_size=4
-                )
-                Settings.embed_model = self.embedding_model
+                self._setup_embedding_model()
                 pbar.update(1)
                 
                 logs.log.info("Models initialized successfully")
         except Exception as e:
             logs.log.error(f"Model initialization failed: {e}")
             raise
+
+   def _setup_llm(self):
+       """Fetch the shared Ollama LLM and register it with llama-index"""
+       # Shared across pipelines so the models are only loaded once per process
+       self.llm = model_registry.get_llm()
+       Settings.llm = self.llm
+
+   def _setup_embedding_model(self):
+       """Fetch the shared embedding model and register it with llama-index"""
+       self.embedding_model = model_registry.get_embedding_model()
+       Settings.embed_model = self.embedding_model
  
-   def process_pdf(self, file_path: str) -> List[Document]:
-       """Process PDF with enhanced LaTeX handling"""
+   def process_pdf(self, file_path: str, workers: Optional[int] = None) -> List[Document]:
+       """Process PDF with enhanced LaTeX handling, fanning page ranges out to worker processes"""
+       return list(self.iter_pdf_documents(file_path, workers))
+
+   def iter_pdf_documents(self, file_path: str, workers: Optional[int] = None) -> Iterator[Document]:
+       """Yield a PDF's Documents in page order while later pages are still being extracted"""
+       in_flight = deque()
        try:
            reader = PdfReader(file_path)
-           documents = []
+           num_pages = len(reader.pages)
+           workers = self.pdf_workers if workers is None else workers
           
-           for page_num, page in enumerate(reader.pages):
-               try:
-                   text = page.extract_text()
-                  
-                   # Extract math environments
-                   math_envs = self.latex_processor.extract_math_environments(text)
-                  
-                   # Process each math environment
-                   for env in math_envs:
-                       searchable_text = self.latex_processor.create_searchable_text(env)
-                      
-                       # Get symbols and ensure they're JSON serializable
-                       symbols = self.latex_processor.categorize_symbols(env['content'])
-                      
-                       doc = Document(
-                           text=env['full'],  # Original LaTeX
-                           metadata={
-                               'type': 'math',
-                               'math_type': env['type'],
-                               'page': page_num + 1,
-                               'searchable_text': searchable_text,
-                               'symbols': symbols  # Now contains lists instead of sets
-                           }
-                       )
-                       documents.append(doc)
-                  
-                   # Process remaining text
-                   remaining_text = text
-                   for env in math_envs:
-                       remaining_text = remaining_text.replace(env['full'], '')
-                  
-                   if remaining_text.strip():
-                       doc = Document(
-                           text=remaining_text.strip(),
-                           metadata={
-                               'type': 'text',
-                               'page': page_num + 1
-                           }
-                       )
-                       documents.append(doc)
-                      
-               except Exception as e:
-                   logs.log.warning(f"Error processing page {page_num + 1}: {str(e)}")
-                   continue
+           if workers <= 1 or num_pages < PARALLEL_MIN_PAGES:
+               for record in iter_page_records(reader, 0, num_pages, self.latex_processor, self.compact_symbols):
+                   yield Document(**record)
+               return
+          
+           # Several ranges per worker so one slow (dense) range does not stall the pool
+           range_size = max(1, -(-num_pages // (workers * 4)))
+           ranges = deque((start, min(start + range_size, num_pages))
+                          for start in range(0, num_pages, range_size))
+          
+           pool = self._extraction_pool(workers)
+           # Bound the ranges in flight so extracted pages never pile up ahead of the consumer
+           while ranges or in_flight:
+               while ranges and len(in_flight) < workers * 2:
+                   start, stop = ranges.popleft()
+                   in_flight.append(pool.submit(extract_page_range, file_path, start, stop, self.compact_symbols))
+               # Yield in submission order to keep the page ordering
+               for record in in_flight.popleft().result():
+                   yield Document(**record)
           
-           return documents
+           logs.log.info(f"Extracted {num_pages} pages from {file_path} with {workers} workers")
           
+       except BrokenProcessPool as e:
+           # A worker died; the next large PDF starts a fresh pool
+           logs.log.error(f"PDF extraction workers failed on {file_path}: {str(e)}")
+           self.close()
+           raise
        except Exception as e:
            logs.log.error(f"Error processing PDF {file_path}: {str(e)}")
            raise
+       finally:
+           # The consumer may stop early; drop the ranges nobody will read
+           for future in in_flight:
+               future.cancel()
+
+   def _extraction_pool(self, workers: int) -> ProcessPoolExecutor:
+       """The pipeline's PDF extraction pool with `workers` processes, started on first use"""
+       with self._pdf_pool_lock:
+           if self._pdf_pool is not None and self._pdf_pool_workers != workers:
+               # Work already submitted to the old pool still finishes
+               self._pdf_pool.shutdown(wait=False)
+               self._pdf_pool = None
+           if self._pdf_pool is None:
+               # Spawn fresh workers: forking copies whatever locks the pipeline's other
+               # threads (model warm-up, API requests) happen to hold at that moment.
+               # Workers only import utils.pdf_extraction, so they start quickly
+               self._pdf_pool = ProcessPoolExecutor(max_workers=workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+               self._pdf_pool_workers = workers
+           return self._pdf_pool
+
+   def close(self) -> None:
+       """Stop the PDF extraction workers and write pending response cache changes.
+
+       The pipeline stays usable: a later large PDF starts new workers.
+       """
+       with self._pdf_pool_lock:
+           pool, self._pdf_pool = self._pdf_pool, None
+       if pool is not None:
+           pool.shutdown()
+       self.response_cache.flush()
 
 
    def load_existing_index(self):
            """Load existing index if available"""
            try:
                if os.path.exists(self.storage_dir):
-                   storage_context = StorageContext.from_defaults(persist_dir=self.storage_dir)
-                   self.index = load_index_from_storage(storage_context)
+                   storage_context = StorageContext.from_defaults(
+                       persist_dir=self.storage_dir,
+                       vector_store=MemmapVectorStore.from_persist_dir(self.storage_dir, dtype=self.vector_dtype)
+                   )
+                   self.index = load_index_from_storage(
+                       storage_context,
+                       embed_model=self.embedding_model
+                   )
+                   self._load_side_indexes()
+                   self._load_index_stamp()
                    logs.log.info("Loaded existing index")
            except Exception as e:
                logs.log.warning(f"Could not load existing index: {e}")
                self.index = None
+           finally:
+               self._index_loaded = True
+
+   def _load_index_stamp(self):
+       """Restore the version stamp persisted with the index; without one the fresh stamp stands"""
+       path = os.path.join(self.storage_dir, INDEX_STAMP_FNAME)
+       if os.path.exists(path):
+           with open(path, "r", encoding="utf-8") as f:
+               self._index_stamp = f.read().strip() or self._index_stamp
+
+   def _load_side_indexes(self):
+       """Load the SIDE_INDEXES persisted in storage_dir, rebuilding any that are missing from the docstore"""
+       for attr, index_cls in SIDE_INDEXES.items():
+           side_index = index_cls.from_persist_dir(self.storage_dir)
+           if side_index is None:
+               # Index persisted before this side index existed
+               side_index = self._new_side_index(attr)
+               side_index.add_nodes(self.index.docstore.docs.values())
+               side_index.persist(self.storage_dir)
+               logs.log.info(f"Rebuilt {attr} from the docstore")
+           setattr(self, attr, side_index)
+
+   def _new_side_index(self, attr: str) -> Any:
+       """An empty side index configured from the pipeline options"""
+       options = {'formula_index': {'use_sympy': self.formula_sympy}}
+       return SIDE_INDEXES[attr](**options.get(attr, {}))
+
+   def _side_indexes(self) -> List[Any]:
+       return [getattr(self, attr) for attr in SIDE_INDEXES if getattr(self, attr) is not None]
+
+   def _insert_nodes(self, nodes: List[Any]) -> None:
+       self.index.insert_nodes(nodes)
+       self._invalidate_query_engines()
+       for side_index in self._side_indexes():
+           side_index.add_nodes(nodes)
+
+   def _delete_ref_doc(self, ref_doc_id: str) -> None:
+       self.index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+       self._invalidate_query_engines()
+       for side_index in self._side_indexes():
+           side_index.delete_ref_docs([ref_doc_id])
+
+   def _persist(self) -> None:
+       """Persist the vector index and its side indexes to storage_dir"""
+       self.index.storage_context.persist(persist_dir=self.storage_dir)
+       for side_index in self._side_indexes():
+           side_index.persist(self.storage_dir)
+       path = os.path.join(self.storage_dir, INDEX_STAMP_FNAME)
+       with open(path + ".tmp", "w", encoding="utf-8") as f:
+           f.write(self._index_stamp)
+       os.replace(path + ".tmp", path)
 
 
    def _ensure_json_serializable(self, obj):
@@ -160,97 +455,723 @@ class RagPipeline:
        else:
            return str(obj)
    def process_documents(self, files: List[Any]) -> None:
-       """Process uploaded documents with enhanced math handling"""
-       documents = []
-      
-       for file in files:
-           try:
-               # Create necessary directories
-               os.makedirs("uploads", exist_ok=True)
-               os.makedirs("pdfs", exist_ok=True)
+       """Process uploaded documents with enhanced math handling, streaming each file into the index"""
+       # Concurrent uploads (e.g. from the async API) are ingested one at a time
+       with self._ingest_lock:
+           for file in files:
+               try:
+                   # Create necessary directories
+                   os.makedirs("uploads", exist_ok=True)
+                   os.makedirs("pdfs", exist_ok=True)
               
-               temp_path = Path("uploads") / file.name
-               with open(temp_path, "wb") as f:
-                   f.write(file.read())
+                   temp_path = Path("uploads") / file.name
+                   with open(temp_path, "wb") as f:
+                       f.write(file.read())
               
-               # Process PDF
-               if file.name.lower().endswith('.pdf'):
-                   # Store a copy in the pdfs folder if it doesn't exist already
-                   pdf_path = Path("pdfs") / file.name
-                   if not pdf_path.exists():
-                       with open(pdf_path, "wb") as f:
-                           # Reset file pointer first
-                           file.seek(0)
-                           f.write(file.read())
-                           logs.log.info(f"Saved PDF {file.name} to pdfs directory")
-                   
-                   docs = self.process_pdf(str(temp_path))
-                   for doc in docs:
-                       # Ensure metadata is JSON serializable and add original file path
-                       doc.metadata = self._ensure_json_serializable(doc.metadata)
-                       doc.metadata['file_path'] = str(pdf_path)
-                   documents.extend(docs)
-               else:
-                   # Handle other file types
-                   with open(temp_path, "r", encoding='utf-8') as f:
-                       content = f.read()
+                   if file.name.lower().endswith('.pdf'):
+                       # Store a copy in the pdfs folder if it doesn't exist already
+                       pdf_path = Path("pdfs") / file.name
+                       if not pdf_path.exists():
+                           with open(pdf_path, "wb") as f:
+                               # Reset file pointer first
+                               file.seek(0)
+                               f.write(file.read())
+                               logs.log.info(f"Saved PDF {file.name} to pdfs directory")
                   
-                   enhanced_doc = self.math_processor.enhance_document(content)
-                   doc = Document(
-                       text=enhanced_doc['searchable_text'],
-                       metadata=self._ensure_json_serializable({
-                           **enhanced_doc['metadata'],
-                           'file_name': file.name
-                       })
-                   )
-                   documents.append(doc)
+                   self._ingest_file(str(temp_path), file.name)
               
-               # Clean up the temporary file
-               if os.path.exists(temp_path):
-                   os.remove(temp_path)
+                   # Clean up the temporary file
+                   if os.path.exists(temp_path):
+                       os.remove(temp_path)
               
-           except Exception as e:
-               logs.log.error(f"Error processing file {file.name}: {e}")
-               continue
+               except Exception as e:
+                   logs.log.error(f"Error processing file {file.name}: {e}")
+                   continue
+
+   def process_paths(self, file_paths: List[str]) -> None:
+       """Process documents already saved to disk (PDFs in the pdfs folder), streaming each file into the index"""
+       with self._ingest_lock:
+           for file_path in file_paths:
+               try:
+                   self._ingest_file(file_path, Path(file_path).name)
+               except Exception as e:
+                   logs.log.error(f"Error processing file {file_path}: {e}")
+                   continue
+
+   def _ingest_file(self, file_path: str, file_name: str) -> None:
+       """Upsert one file read from file_path; file_name identifies its documents across uploads"""
+       if file_name.lower().endswith('.pdf'):
+           self.ingest_pdf(file_path, str(Path("pdfs") / file_name))
+           return
       
-       if documents:
-           self.create_index(documents)
+       # Handle other file types
+       with open(file_path, "r", encoding='utf-8') as f:
+           content = f.read()
+      
+       enhanced_doc = self.math_processor.enhance_document(content)
+       doc = Document(
+           text=enhanced_doc['searchable_text'],
+           metadata=self._ensure_json_serializable({
+               **enhanced_doc['metadata'],
+               'file_name': file_name
+           })
+       )
+       doc.id_ = file_name
+       self.ingest([doc], sources={file_name})
+
+   def ingest_pdf(self, file_path: str, source: Optional[str] = None) -> int:
+       """Upsert the pages of a PDF, removing documents of an earlier version that are gone.
+
+       source is the path recorded on the documents (default file_path); the ids
+       derive from it, so a re-upload read from another path replaces the same documents.
+       Returns the number of documents that had to be (re-)embedded.
+       """
+       source = source or file_path
+       docs = self._with_pdf_metadata(self.iter_pdf_documents(file_path), source)
+       return self.ingest(docs, sources={source})
+
+   def _with_pdf_metadata(self, documents: Iterable[Document], pdf_path: str) -> Iterator[Document]:
+       """Attach the source path and a stable id to each Document of a PDF"""
+       page_counts = {}
+       for doc in documents:
+           # Ensure metadata is JSON serializable and add original file path
+           doc.metadata = self._ensure_json_serializable(doc.metadata)
+           doc.metadata['file_path'] = pdf_path
+           # Stable ids let re-uploads skip unchanged documents
+           page = doc.metadata.get('page', 0)
+           ordinal = page_counts.get(page, 0)
+           page_counts[page] = ordinal + 1
+           doc.id_ = f"{pdf_path}:p{page}:{ordinal}"
+           yield doc
 
 
    def create_index(self, documents: List[Document]) -> None:
-       """Create or update the vector store index"""
+       """Create the index, or upsert documents into the existing one"""
+       sources = {self._source_key(doc.metadata) for doc in documents}
+       sources.discard(None)
+       self.ingest(documents, sources=sources)
+
+   def ingest(self, documents: Iterable[Document], sources: Optional[Set[str]] = None) -> int:
+       """Stream documents into the index in batches with bounded memory.
+
+       A producer thread pulls documents (e.g. page extraction) into a bounded queue
+       while this thread embeds and inserts each batch, persisting every
+       `persist_every` documents so partial results are queryable and survive a crash.
+       Documents of `sources` that were not seen in the stream are removed at the end.
+       Returns the number of documents that had to be (re-)embedded.
+       """
        try:
-           service_context = ServiceContext.from_defaults(
-               llm=self.llm,
-               embed_model=self.embedding_model
-           )
-          
            # Ensure the indexes directory exists
            os.makedirs(self.storage_dir, exist_ok=True)
           
-           self.index = VectorStoreIndex.from_documents(
-               documents,
-               service_context=service_context
+           if self.index is None:
+               self.index = VectorStoreIndex(
+                   nodes=[],
+                   storage_context=StorageContext.from_defaults(
+                       vector_store=MemmapVectorStore(dtype=self.vector_dtype)
+                   ),
+                   embed_model=self.embedding_model
+               )
+               for attr in SIDE_INDEXES:
+                   setattr(self, attr, self._new_side_index(attr))
+               logs.log.info("Created new index")
+          
+           batches = queue.Queue(maxsize=self.ingest_queue_size)
+           stop = threading.Event()
+           producer = threading.Thread(
+               target=self._produce_batches,
+               args=(documents, batches, stop),
+               name="rag-ingest-producer",
+               daemon=True
            )
+           producer.start()
           
-           self.index.storage_context.persist(persist_dir=self.storage_dir)
+           seen = set()
+           embedded = since_persist = 0
+           self._metadata_token_savings = {'nodes': 0, 'embed': 0, 'llm': 0}
+           try:
+               while True:
+                   batch = batches.get()
+                   if batch is _END_OF_STREAM:
+                       break
+                   if isinstance(batch, Exception):
+                       raise batch
+                   seen.update(doc.id_ for doc in batch)
+                   embedded += self.update_index(batch)
+                   since_persist += len(batch)
+                   if since_persist >= self.persist_every:
+                       self._persist()
+                       since_persist = 0
+           finally:
+               stop.set()
           
-           logs.log.info(f"Index created and persisted successfully in {self.storage_dir}")
+           # Documents from a re-uploaded file that no longer exist in the new version
+           stale = self._stale_ref_doc_ids(sources or set(), seen)
+           for ref_doc_id in stale:
+               self._delete_ref_doc(ref_doc_id)
+          
+           self._persist()
+          
+           logs.log.info(
+               f"Ingested {len(seen)} documents ({embedded} embedded, {len(stale)} removed); "
+               f"index persisted in {self.storage_dir}"
+           )
+           savings = self._metadata_token_savings
+           if savings['nodes']:
+               logs.log.info(
+                   f"Hidden metadata saved {savings['embed'] / savings['nodes']:.1f} embedding and "
+                   f"{savings['llm'] / savings['nodes']:.1f} LLM tokens per node over {savings['nodes']} nodes"
+               )
+           return embedded
        except Exception as e:
            logs.log.error(f"Index creation failed: {e}")
            raise
+
+   def _produce_batches(self, documents: Iterable[Document], batches: queue.Queue,
+                        stop: threading.Event) -> None:
+       """Feed fixed-size document batches to the ingestion queue until exhausted or stopped"""
+       def put(item):
+           while not stop.is_set():
+               try:
+                   batches.put(item, timeout=0.1)
+                   return
+               except queue.Full:
+                   continue
+
+       try:
+           batch = []
+           for doc in documents:
+               if stop.is_set():
+                   return
+               batch.append(doc)
+               if len(batch) >= self.ingest_batch_size:
+                   put(batch)
+                   batch = []
+           if batch:
+               put(batch)
+       except Exception as e:
+           put(e)
+       finally:
+           put(_END_OF_STREAM)
+
+   def update_index(self, documents: List[Document]) -> int:
+       """Insert new or changed documents into the loaded index.
+
+       Returns the number of documents that had to be (re-)embedded.
+       """
+       docstore = self.index.docstore
+      
+       changed = []
+       for doc in documents:
+           existing_hash = docstore.get_document_hash(doc.id_)
+           if existing_hash == doc.hash:
+               continue
+           if existing_hash is not None:
+               self._delete_ref_doc(doc.id_)
+           self._apply_metadata_visibility(doc)
+           changed.append(doc)
+      
+       if changed:
+           # Embed every changed document in one batched insert instead of one call per document
+           nodes = run_transformations(changed, [self.node_parser])
+           self._measure_metadata_savings(nodes)
+           self._insert_nodes(nodes)
+           for doc in changed:
+               docstore.set_document_hash(doc.id_, doc.hash)
+      
+       return len(changed)
+
+   def configure_chunking(self, chunk_size: int, chunk_overlap: int) -> None:
+       """Change the node token budgets used for documents embedded from now on"""
+       if (chunk_size, chunk_overlap) != (self.node_parser.chunk_size, self.node_parser.chunk_overlap):
+           self.node_parser = MathAwareNodeParser(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+           logs.log.info(f"Chunking set to {chunk_size} tokens with {chunk_overlap} tokens of overlap")
+
+   def _apply_metadata_visibility(self, doc: Document) -> None:
+       """Hide metadata fields from the embedded text and/or the LLM prompt per metadata_visibility"""
+       visibility = {key: self.metadata_visibility.get(key, 'both') for key in doc.metadata}
+       doc.excluded_embed_metadata_keys = [k for k, v in visibility.items() if v not in ('both', 'embed')]
+       doc.excluded_llm_metadata_keys = [k for k, v in visibility.items() if v not in ('both', 'llm')]
+
+   def _measure_metadata_savings(self, nodes: List[Any]) -> None:
+       """Count the tokens the hidden metadata keeps out of embedding and LLM text"""
+       tokenizer = get_tokenizer()
+       savings = self._metadata_token_savings
+       for node in nodes:
+           full = len(tokenizer(node.get_content(metadata_mode=MetadataMode.ALL)))
+           savings['embed'] += full - len(tokenizer(node.get_content(metadata_mode=MetadataMode.EMBED)))
+           savings['llm'] += full - len(tokenizer(node.get_content(metadata_mode=MetadataMode.LLM)))
+           savings['nodes'] += 1
+
+   def _stale_ref_doc_ids(self, sources: Set[str], keep_ids: Set[str]) -> List[str]:
+       """Find indexed documents of the given source files that are not in keep_ids"""
+       if not sources:
+           return []
+      
+       stale = []
+       # The docstore's ref doc records carry each document's metadata, so no node is loaded
+       for ref_doc_id, info in (self.index.docstore.get_all_ref_doc_info() or {}).items():
+           if ref_doc_id in keep_ids:
+               continue
+           if self._source_key(info.metadata) in sources:
+               stale.append(ref_doc_id)
+       return stale
+
+   def _invalidate_query_engines(self, index_changed: bool = True) -> None:
+       """Bump the index version after any change to the index or LLM; cached engines are dropped"""
+       with self._query_engines_lock:
+           self._index_version += 1
+           self._query_engines.clear()
+           if index_changed:
+               # Cached answers are keyed by the stamp, so they stop matching
+               self._index_stamp = uuid.uuid4().hex
+
+   def _query_engine(self, top_k: int, nprobe: Optional[int] = None, doc_ids: Optional[List[str]] = None,
+                     mode: str = "vector", response_mode: str = "compact",
+                     streaming: bool = False) -> RetrieverQueryEngine:
+       """Query engine for one retrieval configuration, reused until the index changes"""
+       if doc_ids is not None:
+           # Filtered engines depend on a per-query lookup result, so they are not worth caching
+           return self._build_query_engine(top_k, nprobe, doc_ids, mode, response_mode, streaming)
+      
+       with self._query_engines_lock:
+           key = (mode, top_k, nprobe, response_mode, streaming, SYSTEM_PROMPT, self._index_version)
+           engine = self._query_engines.get(key)
+           if engine is not None:
+               self._query_engines.move_to_end(key)
+               return engine
+      
+       engine = self._build_query_engine(top_k, nprobe, doc_ids, mode, response_mode, streaming)
+       with self._query_engines_lock:
+           # Only cache if the index did not change while the engine was being built
+           if key[-1] == self._index_version:
+               self._query_engines[key] = engine
+               while len(self._query_engines) > self.query_engine_cache_size:
+                   self._query_engines.popitem(last=False)
+       return engine
+
+   def _build_query_engine(self, top_k: int, nprobe: Optional[int], doc_ids: Optional[List[str]],
+                           mode: str, response_mode: str, streaming: bool = False) -> RetrieverQueryEngine:
+       """Build a query engine (retriever, response synthesizer and prompts) for one configuration"""
+       if mode == "hybrid":
+           # Each ranking contributes a deeper candidate list; only the fused top_k reach the LLM
+           candidate_k = max(top_k * 4, 20)
+           retriever = HybridRetriever(
+               self.index.as_retriever(
+                   similarity_top_k=candidate_k,
+                   doc_ids=doc_ids,
+                   vector_store_kwargs={'nprobe': nprobe}
+               ),
+               self.bm25_index,
+               self.index.docstore,
+               similarity_top_k=top_k,
+               candidate_k=candidate_k,
+               doc_ids=doc_ids
+           )
+           return RetrieverQueryEngine.from_args(
+               retriever,
+               llm=self.llm,
+               response_mode=response_mode,
+               system_prompt=SYSTEM_PROMPT,
+               streaming=streaming
+           )
+      
+       return self.index.as_query_engine(
+           llm=self.llm,
+           similarity_top_k=top_k,
+           doc_ids=doc_ids,
+           vector_store_kwargs={'nprobe': nprobe},
+           response_mode=response_mode,
+           system_prompt=SYSTEM_PROMPT,
+           streaming=streaming
+       )
+
+   def find_symbols(self, symbols: List[str], match_all: bool = True, limit: int = 20) -> Dict[str, Any]:
+       """Look up math documents by the LaTeX commands they use, without embeddings or the LLM"""
+       if not self.index:
+           raise ValueError("No index available. Please process documents first.")
+      
+       doc_ids = sorted(self.symbol_index.lookup(symbols, match_all=match_all))
+       return {'total': len(doc_ids), 'matches': self._ref_doc_matches(doc_ids[:limit])}
+
+   def find_formula(self, latex: str, alpha_equivalent: bool = True, limit: int = 20,
+                    doc_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+       """Find where a formula is stated, exactly or up to variable renaming, by its structural hash.
+
+       doc_ids, if given, restricts the matches to those documents.
+       """
+       if not self.index:
+           raise ValueError("No index available. Please process documents first.")
+      
+       # Accept the formula with or without its $...$ / environment delimiters
+       content = self.latex_processor.formula_content(latex) or latex
+       matches = self.formula_index.lookup(content, alpha_equivalent=alpha_equivalent)
+       if doc_ids is not None:
+           allowed = set(doc_ids)
+           matches = [(doc_id, kind) for doc_id, kind in matches if doc_id in allowed]
+       kinds = dict(matches)
+       found = self._ref_doc_matches([doc_id for doc_id, _ in matches[:limit]])
+       for match in found:
+           match['match'] = kinds[match['id']]
+       return {'total': len(matches), 'matches': found}
+
+   def search_formulas(self, pattern: str, limit: int = 20, min_match: float = 1.0) -> Dict[str, Any]:
+       """Find formulas containing a LaTeX sub-expression ("..." matches anything) via the n-gram index"""
+       if not self.index:
+           raise ValueError("No index available. Please process documents first.")
+      
+       hits = self.latex_ngram_index.search(pattern, limit=limit, min_match=min_match, texts=self._formula_text)
+       scores = dict(hits)
+       found = self._ref_doc_matches([doc_id for doc_id, _ in hits])
+       for match in found:
+           match['score'] = scores[match['id']]
+       return {'matches': found}
+
+   def _formula_text(self, doc_id: str) -> Optional[str]:
+       """Text of a document's math node, read back from the docstore"""
+       docstore = self.index.docstore
+       ref_doc_info = docstore.get_ref_doc_info(doc_id)
+       if ref_doc_info is None:
+           return None
+       nodes = docstore.get_nodes(ref_doc_info.node_ids, raise_error=False)
+       texts = [node.text for node in nodes if node.metadata.get('type') == 'math']
+       return texts[-1] if texts else None
+
+   def _ref_doc_matches(self, doc_ids: List[str]) -> List[Dict[str, Any]]:
+       """Text and metadata of indexed documents, read back from the docstore"""
+       docstore = self.index.docstore
+       matches = []
+       for doc_id in doc_ids:
+           ref_doc_info = docstore.get_ref_doc_info(doc_id)
+           if ref_doc_info is None:
+               continue
+           nodes = docstore.get_nodes(ref_doc_info.node_ids, raise_error=False)
+           matches.append({
+               'id': doc_id,
+               'text': " ".join(node.text for node in nodes),
+               'metadata': ref_doc_info.metadata
+           })
+       return matches
+
+   def _formula_answer(self, question: str, top_k: int,
+                       doc_ids: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+       """Answer a question that is only a formula from the formula index (within doc_ids), or None to fall through"""
+       if self.formula_index is None:
+           return None
+       content = self.latex_processor.formula_content(question)
+       if content is None:
+           return None
+       found = self.find_formula(content, limit=top_k, doc_ids=doc_ids)
+       if not found['matches']:
+           return None
+      
+       places = ", ".join(
+           f"{Path(self._source_key(m['metadata']) or 'unknown').name} (page {m['metadata'].get('page', '?')})"
+           for m in found['matches']
+       )
+       return {
+           'answer': f"This formula is stated {found['total']} time(s) in the indexed documents, e.g. {places}",
+           'sources': [{
+               'text': m['text'][:200] + "...",
+               'score': 1.0 if m['match'] == 'exact' else 0.9,
+               'metadata': m['metadata'],
+               'match': m['match']
+           } for m in found['matches']],
+           'math_expressions': self._math_entries(self.latex_processor.extract_math_environments(question))
+       }
+
+   @staticmethod
+   def _source_key(metadata: Dict[str, Any]) -> Optional[str]:
+       """The file a document was ingested from"""
+       return metadata.get('file_path') or metadata.get('file_name')
+
+   def _normalize_question(self, question: str) -> str:
+       """Question text for cache keys: whitespace collapsed, prose lowercased, formulas normalized"""
+       parts = []
+       cursor = 0
+       for env in self.latex_processor.extract_math_environments(question):
+           parts.append(question[cursor:env['start']].lower())
+           parts.append(self._normalize_math(env))
+           cursor = env['end']
+       parts.append(question[cursor:].lower())
+       return re.sub(r'\s+', ' ', "".join(parts)).strip()
+
+   def _normalize_math(self, env: Dict[str, Any]) -> str:
+       """One extracted math environment as it appears in cache keys"""
+       return f"<{env['type']}>{self.latex_processor.normalize_math_expression(env['content'])}</{env['type']}>"
+
+   def _semantic_scope(self, question: str, scope: str) -> str:
+       """scope narrowed to the question's normalized math, which the embedding barely tells apart"""
+       math = [self._normalize_math(env) for env in self.latex_processor.extract_math_environments(question)]
+       return ResponseCache.key(scope=scope, math=math)
+
+   def _answer_scope(self, top_k: int, **options: Any) -> str:
+       """Key of everything besides the question that determines an answer: options, models, prompt and index version"""
+       return ResponseCache.key(
+           top_k=top_k,
+           model=self.llm.metadata.model_name,
+           embedding_model=self.embedding_model.model_name,
+           system_prompt=SYSTEM_PROMPT,
+           index=self._index_stamp,
+           **options
+       )
+
+   def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+       """Query embeddings for several questions, in one batch when the embedding model supports it"""
+       model = self.embedding_model
+       if hasattr(model, 'get_query_embedding_batch'):
+           return model.get_query_embedding_batch(queries)
+       return [model.get_query_embedding(query) for query in queries]
+
+   def _chunk_bundles(self, chunks: List[str]) -> List[QueryBundle]:
+       """Query bundles for the chunks of a long question, embedded in one batch"""
+       return [
+           QueryBundle(chunk, embedding=embedding)
+           for chunk, embedding in zip(chunks, self._embed_queries(chunks))
+       ]
+
+   def _query_chunks(self, query_engine: RetrieverQueryEngine, chunks: List[str]) -> List[Any]:
+       """Answer every chunk of a long question concurrently, responses in chunk order.
+
+       The chunks are embedded in one batch and retrieved on up to CHUNK_THREADS
+       threads; at most `chunk_concurrency` synthesis (LLM) calls run at once,
+       and all of it must finish within `query_timeout` seconds.
+       """
+       deadline = time.monotonic() + self.query_timeout
+       bundles = self._chunk_bundles(chunks)
+       llm_slots = threading.BoundedSemaphore(max(1, self.chunk_concurrency))
+      
+       def answer(bundle: QueryBundle) -> Any:
+           nodes = query_engine.retrieve(bundle)
+           with llm_slots:
+               if time.monotonic() > deadline:
+                   raise TimeoutError("Query deadline passed before the chunk reached the LLM")
+               return query_engine.synthesize(bundle, nodes)
+      
+       pool = ThreadPoolExecutor(max_workers=min(len(bundles), CHUNK_THREADS), thread_name_prefix="rag-chunk")
+       futures = {pool.submit(answer, bundle): i for i, bundle in enumerate(bundles)}
+       responses = [None] * len(bundles)
+       try:
+           with tqdm(total=len(bundles), desc="Processing chunks") as chunk_pbar:
+               for future in as_completed(futures, timeout=max(0.0, deadline - time.monotonic())):
+                   responses[futures[future]] = future.result()
+                   chunk_pbar.update(1)
+       except FuturesTimeoutError:
+           raise TimeoutError(f"Long question did not finish within {self.query_timeout:g}s") from None
+       finally:
+           # Do not wait on stragglers past the deadline; their results are discarded
+           pool.shutdown(wait=False, cancel_futures=True)
+       return responses
+
+   def _query_merged_chunks(self, query_engine: RetrieverQueryEngine, question: str, chunks: List[str]) -> Any:
+       """Answer a long question with one LLM call over the merged retrievals of all its chunks.
+
+       Chunks are embedded in one batch and retrieved in parallel; nodes found by
+       several chunks are kept once at their best score, and the best ones that
+       fit in the LLM context window go to a single synthesis call, all within
+       `query_timeout` seconds.
+       """
+       deadline = time.monotonic() + self.query_timeout
+       nodes = self._merged_chunk_nodes(query_engine, question, chunks, deadline)
+       return self._map_before(
+           lambda context: query_engine.synthesize(QueryBundle(question), context), [nodes], deadline
+       )[0]
+
+   def _merged_chunk_nodes(self, query_engine: RetrieverQueryEngine, question: str, chunks: List[str],
+                           deadline: float) -> List[NodeWithScore]:
+       """Retrieve for every chunk in parallel; the merged nodes that fit in one prompt for question"""
+       retrieved = self._map_before(query_engine.retrieve, self._chunk_bundles(chunks), deadline)
+       nodes = self._fit_context(self._merge_hits(retrieved), self._merge_context_budget(query_engine, question))
+       logs.log.info(f"Merged {sum(len(hits) for hits in retrieved)} retrieved nodes of {len(chunks)} chunks into {len(nodes)}")
+       return nodes
+
+   def _merge_context_budget(self, query_engine: RetrieverQueryEngine, question: str) -> int:
+       """Context tokens that reach the LLM in a single synthesis call for question.
+
+       Packs as llama-index's compact synthesizer does: the larger of the QA and
+       refine prompts with the question filled in, plus the answer's tokens and
+       response padding, within the LLM context window. The system prompt is
+       taken off on top, so the merged context never spills into a refine call.
+       """
+       prompts = query_engine.get_prompts()
+       templates = [
+           prompts[f"response_synthesizer:{name}"].partial_format(query_str=question)
+           for name in ("text_qa_template", "refine_template")
+       ]
+       prompt_helper = PromptHelper.from_llm_metadata(self.llm.metadata)
+       try:
+           splitter = prompt_helper.get_text_splitter_given_prompt(
+               get_biggest_prompt(templates), llm=self.llm, padding=DEFAULT_RESPONSE_PADDING_SIZE
+           )
+           budget = splitter.chunk_size - len(get_tokenizer()(SYSTEM_PROMPT))
+       except ValueError:
+           # The question alone fills the window; only the best node goes along
+           budget = 0
+       if self.merge_context_tokens is not None:
+           budget = min(budget, self.merge_context_tokens)
+       return max(budget, 0)
+
+   def _map_before(self, fn: Any, items: List[Any], deadline: float) -> List[Any]:
+       """fn over items on up to CHUNK_THREADS threads, raising TimeoutError unless all finish by deadline (monotonic)"""
+       pool = ThreadPoolExecutor(max_workers=max(1, min(len(items), CHUNK_THREADS)), thread_name_prefix="rag-chunk")
+       try:
+           return list(pool.map(fn, items, timeout=max(0.0, deadline - time.monotonic())))
+       except FuturesTimeoutError:
+           raise TimeoutError(f"Long question did not finish within {self.query_timeout:g}s") from None
+       finally:
+           pool.shutdown(wait=False, cancel_futures=True)
+
+   @staticmethod
+   def _merge_hits(retrieved: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+       """Union of several retrievals, one entry per node at its best score, best first"""
+       best: Dict[str, NodeWithScore] = {}
+       for hits in retrieved:
+           for hit in hits:
+               kept = best.get(hit.node.node_id)
+               if kept is None or (hit.score or 0.0) > (kept.score or 0.0):
+                   best[hit.node.node_id] = hit
+       return sorted(best.values(), key=lambda hit: hit.score or 0.0, reverse=True)
+
+   @staticmethod
+   def _fit_context(hits: List[NodeWithScore], budget: int) -> List[NodeWithScore]:
+       """Leading hits whose LLM-visible text fits in budget tokens; the best hit is always kept"""
+       tokenizer = get_tokenizer()
+       kept = []
+       used = 0
+       for hit in hits:
+           tokens = len(tokenizer(hit.node.get_content(metadata_mode=MetadataMode.LLM)))
+           if kept and used + tokens > budget:
+               break
+           kept.append(hit)
+           used += tokens
+       return kept
        
-   @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry_error_callback=lambda retry_state: {"error": "Query timed out after multiple attempts"}
-    )
-   def query(self, question: str, top_k: int = 3) -> Dict[str, Any]:
-        """Query with enhanced math understanding and timeout handling"""
-        if not self.index:
-            self.load_existing_index()
-            if not self.index:
-                raise ValueError("No index available. Please process documents first.")
+   @staticmethod
+   def _check_query_options(mode: str, chunk_mode: str) -> None:
+       """Reject unknown modes up front, before any retrying or retrieval work"""
+       if mode not in RETRIEVAL_MODES:
+           raise ValueError(f"Unknown retrieval mode {mode!r}; expected one of {RETRIEVAL_MODES}")
+       if chunk_mode not in CHUNK_MODES:
+           raise ValueError(f"Unknown chunk mode {chunk_mode!r}; expected one of {CHUNK_MODES}")
+
+   def _plan_query(self, question: str, top_k: int, nprobe: Optional[int], symbols: Optional[List[str]],
+                   mode: str, chunk_mode: str) -> Dict[str, Any]:
+       """Checks shared by query and query_stream, before any retrieval or LLM work.
+
+       Returns 'result' (an answer that needs no LLM call, else None) and, for
+       the rest of the query, the cache 'scope' and 'cache_key', the question
+       'embedding' and 'semantic_scope' (embedding None when the semantic cache
+       is off or skipped) and the symbol-filtered 'doc_ids'.
+       """
+       if not self.index:
+           self.load_existing_index()
+           if not self.index:
+               raise ValueError("No index available. Please process documents first.")
+      
+       plan = {'result': None, 'embedding': None, 'doc_ids': None}
+       # Repeated questions are answered from the response cache
+       options = {'nprobe': nprobe, 'symbols': sorted(symbols or []), 'mode': mode}
+       if len(question) > LONG_QUESTION_CHARS:
+           options['chunk_mode'] = chunk_mode
+       plan['scope'] = self._answer_scope(top_k, **options)
+       plan['cache_key'] = ResponseCache.key(question=self._normalize_question(question), scope=plan['scope'])
+       plan['result'] = self.response_cache.get(plan['cache_key'])
+       if plan['result'] is not None:
+           logs.log.info("Answered query from the response cache")
+           return plan
+      
+       if symbols:
+           # Symbol pre-filter from the inverted index; vector search then only scores these rows
+           plan['doc_ids'] = sorted(self.symbol_index.lookup(symbols))
+           if not plan['doc_ids']:
+               plan['result'] = {
+                   'answer': f"No indexed formulas use all of: {', '.join(symbols)}",
+                   'sources': [],
+                   'math_expressions': []
+               }
+               return plan
+      
+       # Fast path: a bare formula that is already indexed (and passes the symbol filter)
+       # needs no retrieval or LLM call
+       plan['result'] = self._formula_answer(question, top_k, plan['doc_ids'])
+       if plan['result'] is not None:
+           return plan
+      
+       # Paraphrases of an answered question with the same math are served from the
+       # semantic cache; the embedding is reused for retrieval otherwise. Long questions
+       # are skipped: the embedding model truncates them, so their tails would not count
+       if self.semantic_cache is not None and len(question) <= LONG_QUESTION_CHARS:
+           plan['embedding'] = self.embedding_model.get_query_embedding(question)
+           plan['semantic_scope'] = self._semantic_scope(question, plan['scope'])
+           similar = self.semantic_cache.lookup(plan['embedding'], plan['semantic_scope'])
+           if similar is not None:
+               logs.log.info(f"Answered query from the semantic cache (similarity {similar[1]:.3f})")
+               plan['result'] = similar[0]
+       return plan
+
+   def _cache_result(self, plan: Dict[str, Any], result: Dict[str, Any]) -> None:
+       self.response_cache.put(plan['cache_key'], result)
+       if plan['embedding'] is not None:
+           self.semantic_cache.put(plan['embedding'], plan['semantic_scope'], result)
+
+   @staticmethod
+   def _source_entries(nodes: List[NodeWithScore]) -> List[Dict[str, Any]]:
+       return [{
+           'text': node.node.text[:200] + "...",
+           'score': float(node.score) if node.score else 0.0,
+           'metadata': node.node.metadata
+       } for node in nodes]
+
+   @staticmethod
+   def _format_answer(answer: str, math_expressions: List[Dict[str, Any]]) -> str:
+       """Re-wrap the question's math expressions in the answer in $ / $$ delimiters"""
+       for expr in math_expressions:
+           if expr['type'] == 'inline':
+               answer = answer.replace(expr['content'], f"${expr['content']}$")
+           else:
+               answer = answer.replace(expr['content'], f"$${expr['content']}$$")
+       return answer
+
+   @staticmethod
+   def _math_entries(math_expressions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+       return [{'type': expr['type'], 'content': expr['content']} for expr in math_expressions]
+
+   def _build_result(self, answer: str, sources: List[Dict[str, Any]],
+                     math_expressions: List[Dict[str, Any]], top_k: int) -> Dict[str, Any]:
+       """The query result: formatted answer, top_k sources and the question's math"""
+       return {
+           'answer': self._format_answer(answer, math_expressions),
+           'sources': sources[:top_k],
+           'math_expressions': self._math_entries(math_expressions)
+       }
+
+   @staticmethod
+   def _split_question(question: str) -> List[str]:
+       """A long question in LONG_QUESTION_CHARS pieces"""
+       return [question[i:i + LONG_QUESTION_CHARS] for i in range(0, len(question), LONG_QUESTION_CHARS)]
+
+   def query(self, question: str, top_k: int = 3, nprobe: Optional[int] = None,
+             symbols: Optional[List[str]] = None, mode: str = "vector",
+             chunk_mode: str = "concurrent") -> Dict[str, Any]:
+        """Query with enhanced math understanding and timeout handling
+
+        nprobe trades recall for latency once the vector store has an ANN index
+        (None uses the store default, 0 forces exact search). symbols restricts
+        retrieval to math documents using all of the given LaTeX commands.
+        mode "hybrid" fuses dense and BM25 rankings instead of dense retrieval alone.
+        chunk_mode "merge" answers a long question with one LLM call instead of one per chunk.
+        A question that is just an indexed formula is answered from the formula index.
+        """
+        self._check_query_options(mode, chunk_mode)
+        return self._query(question, top_k, nprobe, symbols, mode, chunk_mode)
+
+   @retry(**QUERY_RETRY)
+   def _query(self, question: str, top_k: int, nprobe: Optional[int], symbols: Optional[List[str]],
+              mode: str, chunk_mode: str) -> Dict[str, Any]:
+        plan = self._plan_query(question, top_k, nprobe, symbols, mode, chunk_mode)
+        if plan['result'] is not None:
+            return plan['result']
+        doc_ids = plan['doc_ids']
             
         try:
             with tqdm(total=5, desc="Processing query") as pbar:
@@ -260,68 +1181,36 @@ class RagPipeline:
                 
                 print("Step 2: Setting up query engine...")
                 # Split long questions if necessary
-                max_chunk_length = 1000
-                if len(question) > max_chunk_length:
+                if len(question) > LONG_QUESTION_CHARS:
                     print("Long question detected, splitting into chunks...")
-                    chunks = [question[i:i + max_chunk_length] 
-                             for i in range(0, len(question), max_chunk_length)]
-                    responses = []
+                    chunks = self._split_question(question)
                     
-                    with tqdm(total=len(chunks), desc="Processing chunks") as chunk_pbar:
-                        for chunk in chunks:
-                            query_engine = self.index.as_query_engine(
-                                similarity_top_k=top_k,
-                                system_prompt="""You are a mathematical assistant specialized in LaTeX and mathematical concepts.
-                                When responding:
-                                1. Always use proper LaTeX notation for mathematical expressions
-                                2. Provide step-by-step explanations for mathematical problems
-                                3. Include relevant mathematical theorems or definitions
-                                4. Format complex equations using display math mode ($$...$$)
-                                5. Use appropriate mathematical symbols and notations""",
-                                streaming=False
-                            )
-                            print(f"\nProcessing chunk {chunk_pbar.n + 1}/{len(chunks)}...")
-                            try:
-                                chunk_response = query_engine.query(chunk)
-                                responses.append(chunk_response)
-                            except Exception as e:
-                                print(f"Error processing chunk: {e}")
-                                raise
-                            chunk_pbar.update(1)
+                    query_engine = self._query_engine(top_k, nprobe, doc_ids, mode)
+                    try:
+                        if chunk_mode == "merge":
+                            # One synthesis over the de-duplicated context of every chunk
+                            responses = [self._query_merged_chunks(query_engine, question, chunks)]
+                        else:
+                            responses = self._query_chunks(query_engine, chunks)
+                    except Exception as e:
+                        print(f"Error processing chunks: {e}")
+                        raise
                     
                     # Combine responses
                     print("\nStep 3: Combining chunk responses...")
                     combined_response = " ".join([str(r.response) for r in responses])
                     sources = []
                     for r in responses:
-                        sources.extend([{
-                            'text': node.node.text[:200] + "...",
-                            'score': float(node.score) if node.score else 0.0,
-                            'metadata': node.node.metadata
-                        } for node in r.source_nodes])
+                        sources.extend(self._source_entries(r.source_nodes))
                 else:
                     print("\nStep 3: Processing single query...")
-                    query_engine = self.index.as_query_engine(
-                        similarity_top_k=top_k,
-                        system_prompt="""You are a mathematical assistant specialized in LaTeX and mathematical concepts.
-                        When responding:
-                        1. Always use proper LaTeX notation for mathematical expressions
-                        2. Provide step-by-step explanations for mathematical problems
-                        3. Include relevant mathematical theorems or definitions
-                        4. Format complex equations using display math mode ($$...$$)
-                        5. Use appropriate mathematical symbols and notations""",
-                        streaming=False
-                    )
+                    query_engine = self._query_engine(top_k, nprobe, doc_ids, mode)
                     
                     try:
                         print("Querying LLM (this might take a while)...")
-                        response = query_engine.query(question)
+                        response = query_engine.query(QueryBundle(question, embedding=plan['embedding']))
                         combined_response = str(response.response)
-                        sources = [{
-                            'text': node.node.text[:200] + "...",
-                            'score': float(node.score) if node.score else 0.0,
-                            'metadata': node.node.metadata
-                        } for node in response.source_nodes]
+                        sources = self._source_entries(response.source_nodes)
                     except httpx.TimeoutException as e:
                         print(f"\nTimeout occurred during LLM query: {e}")
                         raise
@@ -333,42 +1222,127 @@ class RagPipeline:
                 
                 print("\nStep 4: Formatting response...")
                 # Format response with enhanced LaTeX handling
-                formatted_response = combined_response
-                if math_expressions:
-                    for expr in math_expressions:
-                        if expr['type'] == 'inline':
-                            formatted_response = formatted_response.replace(
-                                expr['content'],
-                                f"${expr['content']}$"
-                            )
-                        else:
-                            formatted_response = formatted_response.replace(
-                                expr['content'],
-                                f"$${expr['content']}$$"
-                            )
+                result = self._build_result(combined_response, sources, math_expressions, top_k)
                 pbar.update(1)
                 
-                print("\nStep 5: Preparing final response...")
-                result = {
-                    'answer': formatted_response,
-                    'sources': sources[:top_k],
-                    'math_expressions': [
-                        {
-                            'type': expr['type'],
-                            'content': expr['content']
-                        } for expr in math_expressions
-                    ] if math_expressions else []
-                }
+                print("\nStep 5: Caching final response...")
+                self._cache_result(plan, result)
                 pbar.update(1)
-                
                 print("\nQuery processing completed successfully!")
                 return result
             
-        except httpx.TimeoutException as e:
+        except (httpx.TimeoutException, TimeoutError) as e:
             print(f"\n❌ Query timed out: {e}")
             logs.log.error(f"Query timed out: {e}")
             raise
         except Exception as e:
             print(f"\n❌ Query failed: {e}")
             logs.log.error(f"Query failed: {e}")
-            raise
\ No newline at end of file
+            raise
+
+   def query_stream(self, question: str, top_k: int = 3, nprobe: Optional[int] = None,
+                    symbols: Optional[List[str]] = None, mode: str = "vector") -> Iterator[Dict[str, Any]]:
+        """Answer a question as a stream of events, so clients see sources and tokens as they arrive.
+
+        Yields {'type': 'sources', 'sources', 'math_expressions'} once retrieval is done,
+        {'type': 'token', 'text'} for each piece the LLM generates and finally
+        {'type': 'done', 'answer'} with the formatted answer. Cached and formula
+        answers arrive as one token. Long questions are answered as with chunk_mode "merge".
+        Options are as for query.
+        """
+        self._check_query_options(mode, "merge")
+        plan = self._plan_query(question, top_k, nprobe, symbols, mode, "merge")
+        if plan['result'] is not None:
+            result = plan['result']
+            yield {'type': 'sources', 'sources': result['sources'], 'math_expressions': result['math_expressions']}
+            yield {'type': 'token', 'text': result['answer']}
+            yield {'type': 'done', 'answer': result['answer']}
+            return
+        
+        math_expressions = self.latex_processor.extract_math_environments(question)
+        query_engine = self._query_engine(top_k, nprobe, plan['doc_ids'], mode, streaming=True)
+        if len(question) > LONG_QUESTION_CHARS:
+            chunks = self._split_question(question)
+            nodes = self._merged_chunk_nodes(query_engine, question, chunks, time.monotonic() + self.query_timeout)
+        else:
+            nodes = query_engine.retrieve(QueryBundle(question, embedding=plan['embedding']))
+        
+        sources = self._source_entries(nodes)
+        yield {'type': 'sources', 'sources': sources[:top_k], 'math_expressions': self._math_entries(math_expressions)}
+        
+        pieces = []
+        try:
+            response = query_engine.synthesize(QueryBundle(question), nodes)
+            for piece in response.response_gen:
+                pieces.append(piece)
+                yield {'type': 'token', 'text': piece}
+        except Exception as e:
+            logs.log.error(f"Streaming query failed: {e}")
+            raise
+        
+        result = self._build_result("".join(pieces), sources, math_expressions, top_k)
+        self._cache_result(plan, result)
+        yield {'type': 'done', 'answer': result['answer']}
+
+   async def aquery(self, question: str, top_k: int = 3, nprobe: Optional[int] = None,
+                    symbols: Optional[List[str]] = None, mode: str = "vector",
+                    chunk_mode: str = "concurrent") -> Dict[str, Any]:
+        """query for an event loop: same options and result, without blocking the loop.
+
+        Cache lookups, embedding and retrieval run in worker threads and the LLM
+        is awaited through its async client, so one server process can keep many
+        queries in flight.
+        """
+        self._check_query_options(mode, chunk_mode)
+        return await self._aquery(question, top_k, nprobe, symbols, mode, chunk_mode)
+
+   @retry(**QUERY_RETRY)
+   async def _aquery(self, question: str, top_k: int, nprobe: Optional[int], symbols: Optional[List[str]],
+                     mode: str, chunk_mode: str) -> Dict[str, Any]:
+        plan = await asyncio.to_thread(self._plan_query, question, top_k, nprobe, symbols, mode, chunk_mode)
+        if plan['result'] is not None:
+            return plan['result']
+        
+        math_expressions = self.latex_processor.extract_math_environments(question)
+        query_engine = await asyncio.to_thread(self._query_engine, top_k, nprobe, plan['doc_ids'], mode)
+        try:
+            if len(question) > LONG_QUESTION_CHARS:
+                chunks = self._split_question(question)
+                responses = await asyncio.wait_for(
+                    self._aquery_chunks(query_engine, question, chunks, chunk_mode), timeout=self.query_timeout
+                )
+            else:
+                nodes = await asyncio.to_thread(query_engine.retrieve, QueryBundle(question, embedding=plan['embedding']))
+                responses = [await query_engine.asynthesize(QueryBundle(question), nodes)]
+        except asyncio.TimeoutError:
+            logs.log.error(f"Query timed out after {self.query_timeout:g}s")
+            raise TimeoutError(f"Long question did not finish within {self.query_timeout:g}s") from None
+        except Exception as e:
+            logs.log.error(f"Query failed: {e}")
+            raise
+        
+        sources = [source for r in responses for source in self._source_entries(r.source_nodes)]
+        result = self._build_result(" ".join(str(r.response) for r in responses), sources, math_expressions, top_k)
+        await asyncio.to_thread(self._cache_result, plan, result)
+        return result
+
+   async def _aquery_chunks(self, query_engine: RetrieverQueryEngine, question: str, chunks: List[str],
+                            chunk_mode: str) -> List[Any]:
+       """Responses for a long question: one per chunk (at most `chunk_concurrency` LLM calls at once) or one merged"""
+       if chunk_mode == "merge":
+           nodes = await asyncio.to_thread(
+               self._merged_chunk_nodes, query_engine, question, chunks, time.monotonic() + self.query_timeout
+           )
+           return [await query_engine.asynthesize(QueryBundle(question), nodes)]
+      
+       bundles = await asyncio.to_thread(self._chunk_bundles, chunks)
+       retrieved = await asyncio.to_thread(
+           self._map_before, query_engine.retrieve, bundles, time.monotonic() + self.query_timeout
+       )
+       llm_slots = asyncio.Semaphore(max(1, self.chunk_concurrency))
+      
+       async def answer(bundle: QueryBundle, nodes: List[NodeWithScore]) -> Any:
+           async with llm_slots:
+               return await query_engine.asynthesize(bundle, nodes)
+      
+       return await asyncio.gather(*(answer(bundle, nodes) for bundle, nodes in zip(bundles, retrieved)))
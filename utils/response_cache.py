@@ -0,0 +1,244 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils import logs
+
+
+class ResponseCache:
+    """LRU + TTL cache of query results, optionally persisted to a JSON file.
+
+    Keys are built by the caller from everything that determines an answer
+    (normalized question, top_k, model, index version, ...), so entries never
+    need explicit invalidation: a changed index or model simply stops matching
+    them and they age out.
+
+    Changes reach the file from a background flush flush_interval seconds after
+    the first of them, so queries never wait on the write; call flush() before
+    exiting to keep the latest answers.
+    """
+
+    FNAME = "response_cache.json"
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0, path: Optional[str] = None,
+                 flush_interval: float = 5.0):
+        self.max_entries = max_entries
+        # Seconds an answer stays valid; None keeps it until evicted
+        self.ttl = ttl
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Serializes writes of the file; taken before _lock, never while holding it
+        self._flush_lock = threading.Lock()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._dirty = False
+        # key -> (stored at, result), least recently used first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        """Hash of the named parts that determine an answer"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """A copy of the cached result for key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0], time.time()):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Callers may decorate the result; the cached copy must not change
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), copy.deepcopy(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._schedule_flush()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        """Mark the entries changed and start the flush timer if none is pending (called with the lock held)"""
+        if not self.path:
+            return
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self) -> None:
+        """Write the live entries to path now if they changed since the last write"""
+        with self._flush_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                now = time.time()
+                # Stored results are never mutated (put and get copy them), so the
+                # snapshot can be serialized after the lock is released
+                entries = [
+                    [key, stored_at, result] for key, (stored_at, result) in self._entries.items()
+                    if not self._expired(stored_at, now)
+                ]
+            self._write(entries)
+
+    def _write(self, entries: List[list]) -> None:
+        """Atomically replace path with the given entries"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, default=str)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            # A cache that cannot be written is still usable in memory
+            logs.log.warning(f"Could not persist response cache to {self.path}: {e}")
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logs.log.warning(f"Ignoring unreadable response cache {self.path}: {e}")
+            return
+        now = time.time()
+        for key, stored_at, result in data["entries"][-self.max_entries:]:
+            if not self._expired(stored_at, now):
+                self._entries[key] = (stored_at, result)
+        logs.log.info(f"Loaded response cache from {self.path} with {len(self._entries):,} entries")
+
+
+class SemanticCache:
+    """Query results served again for questions whose embedding is close enough.
+
+    Question embeddings are kept L2-normalized in one matrix, so a lookup is a
+    single matrix-vector product over every entry. Only entries with the same
+    scope (a key of everything but the question: options, models and index
+    version) can match.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1024, ttl: float = 3600.0):
+        # Minimum cosine similarity to reuse an answer; bge scores unrelated
+        # questions ~0.6-0.8, so paraphrases need a high bar
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._scopes = np.empty(0, dtype=object)
+        self._stored_at = np.empty(0, dtype=np.float64)
+        self._last_used = np.empty(0, dtype=np.float64)
+        self._results: List[Dict[str, Any]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    @staticmethod
+    def _unit(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, embedding: Sequence[float], scope: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """(copy of the result, similarity) of the closest live entry in scope, or None below the threshold"""
+        query = self._unit(embedding)
+        with self._lock:
+            n = len(self._results)
+            if n == 0 or self._matrix.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            now = time.time()
+            scores = self._matrix[:n] @ query
+            live = self._scopes[:n] == scope
+            if self.ttl is not None:
+                live &= now - self._stored_at[:n] <= self.ttl
+            scores[~live] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            return copy.deepcopy(self._results[best]), float(scores[best])
+
+    def put(self, embedding: Sequence[float], scope: str, result: Dict[str, Any]) -> None:
+        vector = self._unit(embedding)
+        now = time.time()
+        with self._lock:
+            n = len(self._results)
+            if n and self._matrix.shape[1] != vector.shape[0]:
+                # A different embedding model: earlier vectors are not comparable
+                self._reset(vector.shape[0])
+                n = 0
+            if n >= self.max_entries:
+                # Overwrite the least recently used entry
+                row = int(np.argmin(self._last_used[:n]))
+                self._results[row] = copy.deepcopy(result)
+            else:
+                if n == self._matrix.shape[0]:
+                    self._grow(max(16, 2 * n), vector.shape[0])
+                row = n
+                self._results.append(copy.deepcopy(result))
+            self._matrix[row] = vector
+            self._scopes[row] = scope
+            self._stored_at[row] = self._last_used[row] = now
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset(self._matrix.shape[1])
+
+    def _reset(self, dim: int) -> None:
+        self._matrix = np.empty((0, dim), dtype=np.float32)
+        self._scopes = np.empty(0, dtype=object)
+        self._stored_at = np.empty(0, dtype=np.float64)
+        self._last_used = np.empty(0, dtype=np.float64)
+        self._results = []
+
+    def _grow(self, capacity: int, dim: int) -> None:
+        """Reallocate the row arrays to hold capacity entries (capped at max_entries)"""
+        capacity = min(capacity, self.max_entries)
+        n = len(self._results)
+        matrix = np.empty((capacity, dim), dtype=np.float32)
+        if n:
+            matrix[:n] = self._matrix[:n]
+        self._matrix = matrix
+        for attr in ('_scopes', '_stored_at', '_last_used'):
+            old = getattr(self, attr)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, attr, new)
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from utils import logs
+from utils.latex_symbols_processor import decode_symbols
+
+
+class SymbolIndex:
+    """Inverted index from LaTeX symbol commands to the math documents that use them.
+
+    Posting lists hold ref doc ids (one per extracted math environment), which
+    VectorIndexRetriever accepts as `doc_ids`, so a lookup can both answer on its
+    own and pre-filter vector retrieval.
+    """
+
+    FNAME = "symbol_index.json"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings: Dict[str, Set[str]] = {}
+        self._doc_symbols: Dict[str, Set[str]] = {}
+
+    @staticmethod
+    def normalize(symbol: str) -> str:
+        """'oint', '\\oint' and ' \\oint ' all name the same posting list"""
+        return '\\' + symbol.strip().lstrip('\\')
+
+    @staticmethod
+    def node_symbols(metadata: Dict[str, Any]) -> Set[str]:
+        """Symbols recorded on a node, from its 'symbols_mask' bitset or 'symbols' lists"""
+        if 'symbols_mask' in metadata:
+            categories = decode_symbols(metadata['symbols_mask'])
+        else:
+            categories = metadata.get('symbols') or {}
+        return {symbol for symbols in categories.values() for symbol in symbols}
+
+    @property
+    def num_documents(self) -> int:
+        return len(self._doc_symbols)
+
+    def add_nodes(self, nodes: Iterable[Any]) -> None:
+        """Post the symbols of each math node under its ref doc id"""
+        with self._lock:
+            for node in nodes:
+                symbols = self.node_symbols(node.metadata)
+                if not symbols:
+                    continue
+                doc_id = node.ref_doc_id or node.node_id
+                self._doc_symbols.setdefault(doc_id, set()).update(symbols)
+                for symbol in symbols:
+                    self._postings.setdefault(symbol, set()).add(doc_id)
+
+    def delete_ref_docs(self, ref_doc_ids: Iterable[str]) -> None:
+        with self._lock:
+            for doc_id in ref_doc_ids:
+                for symbol in self._doc_symbols.pop(doc_id, ()):
+                    posting = self._postings.get(symbol)
+                    if posting is None:
+                        continue
+                    posting.discard(doc_id)
+                    if not posting:
+                        del self._postings[symbol]
+
+    def lookup(self, symbols: Iterable[str], match_all: bool = True) -> Set[str]:
+        """Ref doc ids using all (or, with match_all=False, any) of the given symbols"""
+        with self._lock:
+            postings = [self._postings.get(self.normalize(symbol), set()) for symbol in symbols]
+            if not postings:
+                return set()
+            if not match_all:
+                return set().union(*postings)
+            # Intersect smallest first so the working set only ever shrinks
+            postings.sort(key=len)
+            result = set(postings[0])
+            for posting in postings[1:]:
+                if not result:
+                    break
+                result &= posting
+            return result
+
+    def symbol_counts(self) -> Dict[str, int]:
+        """Number of documents using each indexed symbol"""
+        with self._lock:
+            return {symbol: len(posting) for symbol, posting in self._postings.items()}
+
+    def persist(self, persist_dir: str) -> None:
+        """Atomically write the posting lists to persist_dir"""
+        with self._lock:
+            data = {symbol: sorted(posting) for symbol, posting in self._postings.items()}
+        path = os.path.join(persist_dir, self.FNAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"postings": data}, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> Optional["SymbolIndex"]:
+        """Load a persisted index, or None if persist_dir has none"""
+        path = os.path.join(persist_dir, cls.FNAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            postings: Dict[str, List[str]] = json.load(f)["postings"]
+
+        index = cls()
+        for symbol, doc_ids in postings.items():
+            index._postings[symbol] = set(doc_ids)
+            for doc_id in doc_ids:
+                index._doc_symbols.setdefault(doc_id, set()).add(symbol)
+        logs.log.info(f"Loaded symbol index with {len(postings)} symbols over {index.num_documents:,} documents")
+        return index
@@ -0,0 +1,84 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Rows scored per matrix product; bounds the float32 scratch space for float16 or memory-mapped blocks
+CHUNK_ROWS = 65536
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize each row of a 2-D array (zero rows are left as zeros)"""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores along the last axis, best first.
+
+    Uses argpartition so only the k winners are sorted.
+    """
+    n = scores.shape[-1]
+    if k >= n:
+        return np.argsort(-scores, axis=-1)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def search(
+    blocks: Sequence[np.ndarray],
+    queries: np.ndarray,
+    k: int,
+    masks: Optional[Sequence[Optional[np.ndarray]]] = None,
+) -> List[List[Tuple[int, int, float]]]:
+    """Cosine top-k over row-normalized blocks that together form one logical matrix.
+
+    Args:
+        blocks: 2-D arrays of L2-normalized rows (in-memory or np.memmap).
+        queries: A single query vector or a (n_queries, dim) batch.
+        k: Number of results per query.
+        masks: Optional boolean array per block; False rows are never returned.
+
+    Returns:
+        For each query, up to k (block, row, score) tuples ordered best first.
+    """
+    queries = normalize_rows(queries)
+    n_queries = queries.shape[0]
+    if k <= 0:
+        return [[] for _ in range(n_queries)]
+
+    cand_scores, cand_blocks, cand_rows = [], [], []
+    for b, block in enumerate(blocks):
+        mask = masks[b] if masks is not None else None
+        for start in range(0, block.shape[0], CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, block.shape[0])
+            if mask is not None and not mask[start:stop].any():
+                continue
+            scores = queries @ np.asarray(block[start:stop], dtype=np.float32).T
+            if mask is not None:
+                scores[:, ~mask[start:stop]] = -np.inf
+            idx = top_k_indices(scores, k)
+            cand_scores.append(np.take_along_axis(scores, idx, axis=1))
+            cand_rows.append(idx + start)
+            cand_blocks.append(np.full(idx.shape, b))
+
+    if not cand_scores:
+        return [[] for _ in range(n_queries)]
+
+    scores = np.concatenate(cand_scores, axis=1)
+    rows = np.concatenate(cand_rows, axis=1)
+    block_ids = np.concatenate(cand_blocks, axis=1)
+    best = top_k_indices(scores, k)
+
+    results = []
+    for q in range(n_queries):
+        hits = []
+        for i in best[q]:
+            score = scores[q, i]
+            if not np.isfinite(score):
+                break
+            hits.append((int(block_ids[q, i]), int(rows[q, i]), float(score)))
+        results.append(hits)
+    return results
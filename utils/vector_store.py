@@ -0,0 +1,518 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.simple import SimpleVectorStore
+
+from utils import logs
+from utils.ann_index import IVFIndex
+from utils.vector_search import normalize_rows, search
+
+META_FNAME = "memmap_vector_store.json"
+LEGACY_FNAME = "default__vector_store.json"
+IVF_FNAME = "ivf_index.npz"
+
+
+class MemmapVectorStore(BasePydanticVectorStore):
+    """Vector store persisted as binary .npy segments that are memory-mapped on load.
+
+    Rows are L2-normalized when added, so cosine similarity is a plain dot product.
+    Each persist writes only the rows added since the last one as a new segment;
+    deletions are tombstoned in the side table. Compaction is tiered: it only
+    rewrites the smallest segments and those mostly made of tombstones, so the
+    large memory-mapped segments of a growing corpus are left alone.
+
+    Once the store holds `ann_min_vectors` rows an IVF index is trained at persist
+    time and queries only score the `nprobe` closest lists (pass nprobe=0 for exact
+    search). New rows are assigned to the existing lists as they are added, and the
+    index is retrained when the store has grown 4x since training. Segments are
+    written with their rows grouped by list, so a probe reads one contiguous
+    slice per list; only the in-memory tail is scanned for its lists.
+
+    Mutations and persists hold a lock. A query only takes it to snapshot the
+    segment list and its row masks, then scores outside it, so queries run
+    alongside each other and alongside ingestion.
+    """
+
+    stores_text: bool = False
+    is_embedding_query: bool = True
+    dtype: str = "float32"
+    max_segments: int = 8
+    max_deleted_ratio: float = 0.25
+    ann_min_vectors: int = 50_000
+    ann_nprobe: int = 16
+
+    # Each segment: {'file', 'matrix', 'ids', 'ref_doc_ids', 'alive', 'lists', 'offsets'}; file is None
+    # until persisted. 'offsets' (n_lists + 1 row offsets) is set while the rows are grouped by list
+    _segments: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _locations: Dict[str, Tuple[int, int]] = PrivateAttr(default_factory=dict)
+    _ref_docs: Dict[str, Set[str]] = PrivateAttr(default_factory=dict)
+    _obsolete_files: List[str] = PrivateAttr(default_factory=list)
+    _ivf: Optional[IVFIndex] = PrivateAttr(default=None)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+
+    def __init__(self, dtype: str = "float32", **kwargs: Any):
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        super().__init__(dtype=dtype, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MemmapVectorStore"
+
+    @property
+    def client(self) -> None:
+        return None
+
+    @property
+    def num_vectors(self) -> int:
+        """Number of live vectors (not a __len__, so an empty store stays truthy for llama-index)"""
+        return len(self._locations)
+
+    ###################################
+    #
+    # Loading
+    #
+    ###################################
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, dtype: str = "float32") -> "MemmapVectorStore":
+        """Open a persisted store, importing a legacy JSON SimpleVectorStore if that is all there is"""
+        store = cls(dtype=dtype)
+        meta_path = os.path.join(persist_dir, META_FNAME)
+        legacy_path = os.path.join(persist_dir, LEGACY_FNAME)
+
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            store.dtype = meta.get("dtype", dtype)
+            for entry in meta["segments"]:
+                matrix = np.load(os.path.join(persist_dir, entry["file"]), mmap_mode="r")
+                alive = np.ones(len(entry["ids"]), dtype=bool)
+                alive[entry.get("deleted", [])] = False
+                store._append_segment(entry["file"], matrix, entry["ids"], entry["ref_doc_ids"], alive)
+            ivf_path = os.path.join(persist_dir, IVF_FNAME)
+            if os.path.exists(ivf_path):
+                store._ivf, segment_lists = IVFIndex.load(ivf_path)
+                for segment in store._segments:
+                    lists = segment_lists.get(segment['file'])
+                    segment['lists'] = lists if lists is not None else store._ivf.assign(segment['matrix'])
+                    segment['offsets'] = store._list_offsets(segment['lists'])
+            logs.log.info(f"Memory-mapped {store.num_vectors:,} vectors from {persist_dir}")
+        elif os.path.exists(legacy_path):
+            store._import_simple_vector_store(SimpleVectorStore.from_persist_path(legacy_path))
+            store._obsolete_files.append(LEGACY_FNAME)
+            logs.log.info(f"Imported {store.num_vectors:,} vectors from legacy {LEGACY_FNAME}")
+        return store
+
+    def _import_simple_vector_store(self, legacy: SimpleVectorStore) -> None:
+        data = legacy.data
+        ids = list(data.embedding_dict.keys())
+        if not ids:
+            return
+        matrix = self._normalize(np.asarray([data.embedding_dict[i] for i in ids], dtype=np.float32))
+        ref_doc_ids = [data.text_id_to_ref_doc_id.get(i) for i in ids]
+        self._append_segment(None, matrix, ids, ref_doc_ids, np.ones(len(ids), dtype=bool))
+
+    def _append_segment(self, file: Optional[str], matrix: np.ndarray, ids: List[str],
+                        ref_doc_ids: List[Optional[str]], alive: np.ndarray,
+                        lists: Optional[np.ndarray] = None) -> None:
+        seg_idx = len(self._segments)
+        if lists is None and self._ivf is not None:
+            lists = self._ivf.assign(matrix)
+        self._segments.append({
+            'file': file,
+            'matrix': matrix,
+            'ids': list(ids),
+            'ref_doc_ids': list(ref_doc_ids),
+            'alive': alive,
+            'lists': lists,
+            'offsets': self._list_offsets(lists) if file is not None else None
+        })
+        for row, (node_id, ref_doc_id) in enumerate(zip(ids, ref_doc_ids)):
+            if not alive[row]:
+                continue
+            self._locations[node_id] = (seg_idx, row)
+            if ref_doc_id is not None:
+                self._ref_docs.setdefault(ref_doc_id, set()).add(node_id)
+
+    ###################################
+    #
+    # Mutation
+    #
+    ###################################
+
+    def _normalize(self, matrix: np.ndarray) -> np.ndarray:
+        return normalize_rows(matrix).astype(self.dtype)
+
+    def _tail(self) -> Dict[str, Any]:
+        """The in-memory segment that collects rows added since the last persist"""
+        if not self._segments or self._segments[-1]['file'] is not None:
+            dim = self._segments[-1]['matrix'].shape[1] if self._segments else 0
+            self._append_segment(None, np.empty((0, dim), dtype=self.dtype), [], [], np.ones(0, dtype=bool))
+        return self._segments[-1]
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        rows = self._normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._lock:
+            self._add_rows(nodes, rows)
+        return [node.node_id for node in nodes]
+
+    def _add_rows(self, nodes: List[BaseNode], rows: np.ndarray) -> None:
+        """Append rows to the tail segment (lock held), replacing its arrays rather than
+        growing them in place so query snapshots stay consistent"""
+        for node in nodes:
+            if node.node_id in self._locations:
+                self._delete_node(node.node_id)
+
+        tail = self._tail()
+        if tail['matrix'].shape[0] == 0:
+            tail['matrix'] = rows
+        else:
+            tail['matrix'] = np.vstack([tail['matrix'], rows])
+
+        seg_idx = len(self._segments) - 1
+        offset = len(tail['ids'])
+        tail['alive'] = np.concatenate([tail['alive'], np.ones(len(nodes), dtype=bool)])
+        if self._ivf is not None:
+            tail['lists'] = np.concatenate([tail['lists'], self._ivf.assign(rows)])
+            tail['offsets'] = None
+        for i, node in enumerate(nodes):
+            tail['ids'].append(node.node_id)
+            tail['ref_doc_ids'].append(node.ref_doc_id)
+            self._locations[node.node_id] = (seg_idx, offset + i)
+            if node.ref_doc_id is not None:
+                self._ref_docs.setdefault(node.ref_doc_id, set()).add(node.node_id)
+
+    def _delete_node(self, node_id: str) -> None:
+        location = self._locations.pop(node_id, None)
+        if location is None:
+            return
+        seg_idx, row = location
+        segment = self._segments[seg_idx]
+        segment['alive'][row] = False
+        ref_doc_id = segment['ref_doc_ids'][row]
+        if ref_doc_id in self._ref_docs:
+            self._ref_docs[ref_doc_id].discard(node_id)
+            if not self._ref_docs[ref_doc_id]:
+                del self._ref_docs[ref_doc_id]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            for node_id in list(self._ref_docs.get(ref_doc_id, ())):
+                self._delete_node(node_id)
+
+    def delete_nodes(self, node_ids: Optional[List[str]] = None, filters: Any = None,
+                     **delete_kwargs: Any) -> None:
+        with self._lock:
+            for node_id in node_ids or []:
+                self._delete_node(node_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._obsolete_files.extend(s['file'] for s in self._segments if s['file'])
+            self._ivf = None
+            self._segments = []
+            self._locations = {}
+            self._ref_docs = {}
+
+    ###################################
+    #
+    # Query
+    #
+    ###################################
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by MemmapVectorStore")
+        if query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        return self.batch_query(
+            [query.query_embedding],
+            query.similarity_top_k,
+            doc_ids=query.doc_ids,
+            node_ids=query.node_ids,
+            nprobe=kwargs.get('nprobe')
+        )[0]
+
+    def batch_query(
+        self,
+        query_embeddings: List[List[float]],
+        similarity_top_k: int,
+        doc_ids: Optional[List[str]] = None,
+        node_ids: Optional[List[str]] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[VectorStoreQueryResult]:
+        """Top-k search for several query embeddings with one matrix product per segment.
+
+        `nprobe` sets how many IVF lists are scanned when an ANN index exists
+        (None uses `ann_nprobe`, 0 forces exact search).
+        """
+        with self._lock:
+            num_live = len(self._locations)
+            if not num_live:
+                return [VectorStoreQueryResult(nodes=None, similarities=[], ids=[]) for _ in query_embeddings]
+            # Segment dicts are copied and the masks built fresh, so later adds, deletes
+            # and compactions do not change what this query scores
+            segments = [dict(segment) for segment in self._segments]
+            masks = self._masks(segments, doc_ids, node_ids)
+            ivf = self._ivf
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        nprobe = self.ann_nprobe if nprobe is None else nprobe
+        filtered = doc_ids is not None or (node_ids is not None and len(node_ids) < num_live)
+        if filtered:
+            # Pre-filtered candidates (e.g. from a symbol lookup) are usually few: score just those rows
+            hits = [self._gathered_search(segments, q, similarity_top_k, masks) for q in queries]
+        elif ivf is None or nprobe <= 0 or nprobe >= ivf.n_lists:
+            hits = search([segment['matrix'] for segment in segments], queries, similarity_top_k, masks=masks)
+        else:
+            hits = [self._ann_search(segments, ivf, q, similarity_top_k, masks, nprobe) for q in queries]
+
+        return [
+            VectorStoreQueryResult(
+                nodes=None,
+                similarities=[score for _, _, score in query_hits],
+                ids=[segments[seg_idx]['ids'][row] for seg_idx, row, _ in query_hits]
+            )
+            for query_hits in hits
+        ]
+
+    def _ann_search(self, segments: List[Dict[str, Any]], ivf: IVFIndex, query: np.ndarray, k: int,
+                    masks: List[np.ndarray], nprobe: int):
+        """Score only the rows in the query's closest IVF lists.
+
+        Grouped segments are read one contiguous slice per probed list; others
+        (the unpersisted tail) have their probed rows gathered.
+        """
+        # In list order, so the slices of a segment are read front to back
+        probes = np.sort(ivf.probe(query, nprobe))
+        blocks, block_masks, origins = [], [], []
+        for seg_idx, (segment, mask) in enumerate(zip(segments, masks)):
+            offsets = segment['offsets']
+            if offsets is None:
+                rows = np.flatnonzero(mask & np.isin(segment['lists'], probes))
+                blocks.append(segment['matrix'][rows])
+                block_masks.append(None)
+                origins.append((seg_idx, rows))
+                continue
+            for start, stop in zip(offsets[probes], offsets[probes + 1]):
+                if stop > start:
+                    blocks.append(segment['matrix'][start:stop])
+                    block_masks.append(mask[start:stop])
+                    origins.append((seg_idx, np.arange(start, stop)))
+        hits = search(blocks, query, k, masks=block_masks)[0]
+        return [(origins[b][0], int(origins[b][1][row]), score) for b, row, score in hits]
+
+    @staticmethod
+    def _gathered_search(segments: List[Dict[str, Any]], query: np.ndarray, k: int, masks: List[np.ndarray]):
+        """Exact search over only the masked rows, gathered out of each segment"""
+        rows = [np.flatnonzero(mask) for mask in masks]
+        hits = search([segment['matrix'][r] for segment, r in zip(segments, rows)], query, k)[0]
+        return [(seg_idx, int(rows[seg_idx][i]), score) for seg_idx, i, score in hits]
+
+    def _masks(self, segments: List[Dict[str, Any]], doc_ids: Optional[List[str]],
+               node_ids: Optional[List[str]]) -> List[np.ndarray]:
+        """Per-segment row masks (new arrays): live rows, narrowed to the requested documents or nodes"""
+        if node_ids is not None and len(node_ids) >= len(self._locations):
+            # VectorStoreIndex.as_retriever() passes every node id by default; that is no filter
+            node_ids = None
+        if doc_ids is None and node_ids is None:
+            # Deletes clear 'alive' flags in place
+            return [segment['alive'].copy() for segment in segments]
+
+        allowed = set(node_ids) if node_ids is not None else None
+        if doc_ids is not None:
+            from_docs = {n for d in doc_ids for n in self._ref_docs.get(d, ())}
+            allowed = from_docs if allowed is None else allowed & from_docs
+
+        masks = [np.zeros(len(segment['ids']), dtype=bool) for segment in segments]
+        for node_id in allowed:
+            location = self._locations.get(node_id)
+            if location is not None:
+                masks[location[0]][location[1]] = True
+        return masks
+
+    ###################################
+    #
+    # Persistence
+    #
+    ###################################
+
+    def persist(self, persist_path: str, fs: Any = None) -> None:
+        """Write new rows as a segment next to persist_path and update the side table"""
+        with self._lock:
+            persist_dir = os.path.dirname(persist_path) or "."
+            os.makedirs(persist_dir, exist_ok=True)
+
+            merge = self._segments_to_merge()
+            if merge:
+                self._compact(merge)
+
+            if self.num_vectors >= self.ann_min_vectors and (
+                self._ivf is None or self.num_vectors > 4 * self._ivf.trained_size
+            ):
+                self.build_ann_index()
+
+            for seg_idx, segment in enumerate(self._segments):
+                if segment['file'] is None and len(segment['ids']):
+                    if segment['lists'] is not None:
+                        self._group_rows(seg_idx)
+                        segment = self._segments[seg_idx]
+                    file = f"vectors-{uuid.uuid4().hex[:12]}.npy"
+                    path = os.path.join(persist_dir, file)
+                    np.save(path, np.ascontiguousarray(segment['matrix'], dtype=self.dtype))
+                    # A new dict, so query snapshots of the in-memory segment stay as they were
+                    self._segments[seg_idx] = {
+                        **segment,
+                        'file': file,
+                        'matrix': np.load(path, mmap_mode="r"),
+                        'offsets': self._list_offsets(segment['lists'])
+                    }
+
+            if self._ivf is not None:
+                tmp_path = os.path.join(persist_dir, "ivf_index.tmp.npz")
+                self._ivf.save(tmp_path, {s['file']: s['lists'] for s in self._segments if s['file'] is not None})
+                os.replace(tmp_path, os.path.join(persist_dir, IVF_FNAME))
+
+            meta = {
+                'dtype': self.dtype,
+                'segments': [
+                    {
+                        'file': s['file'],
+                        'ids': s['ids'],
+                        'ref_doc_ids': s['ref_doc_ids'],
+                        'deleted': np.flatnonzero(~s['alive']).tolist()
+                    }
+                    for s in self._segments if s['file'] is not None
+                ]
+            }
+            tmp_path = os.path.join(persist_dir, META_FNAME + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, os.path.join(persist_dir, META_FNAME))
+
+            # Only remove replaced files once the side table no longer points at them
+            for file in self._obsolete_files:
+                path = os.path.join(persist_dir, file)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._obsolete_files = []
+
+    def _segments_to_merge(self) -> List[int]:
+        """Indices of the segments worth rewriting: tombstone-heavy ones, plus the smallest while there are too many"""
+        live = [int(segment['alive'].sum()) for segment in self._segments]
+        chosen = {
+            i for i, segment in enumerate(self._segments)
+            if segment['ids'] and 1 - live[i] / len(segment['ids']) > self.max_deleted_ratio
+        }
+        if len(self._segments) > self.max_segments:
+            # Merge the smallest down to half the limit. New segments are small and large ones
+            # are rarely among the smallest, so a row is rewritten about log(n) times, not per overflow
+            by_size = sorted((i for i in range(len(self._segments)) if i not in chosen), key=live.__getitem__)
+            extra = len(self._segments) - len(chosen) + 1 - self.max_segments // 2
+            chosen.update(by_size[:extra])
+        return sorted(chosen)
+
+    def _compact(self, merge: List[int]) -> None:
+        """Rewrite the given segments as one in-memory segment holding only their live rows"""
+        ivf = self._ivf
+        merge_set = set(merge)
+        kept = [segment for i, segment in enumerate(self._segments) if i not in merge_set]
+        matrices, ids, ref_doc_ids, lists = [], [], [], []
+        for i in merge:
+            segment = self._segments[i]
+            alive = segment['alive']
+            if alive.any():
+                matrices.append(np.asarray(segment['matrix'][alive]))
+                ids.extend(n for n, keep in zip(segment['ids'], alive) if keep)
+                ref_doc_ids.extend(r for r, keep in zip(segment['ref_doc_ids'], alive) if keep)
+                if ivf is not None:
+                    lists.append(segment['lists'][alive])
+        dim = self._segments[0]['matrix'].shape[1]
+        matrix = np.vstack(matrices) if matrices else np.empty((0, dim), dtype=self.dtype)
+
+        # Segment positions shift, so the id tables are rebuilt; kept segments keep their files and rows
+        self._obsolete_files.extend(self._segments[i]['file'] for i in merge if self._segments[i]['file'])
+        self._segments, self._locations, self._ref_docs = [], {}, {}
+        for segment in kept:
+            self._append_segment(
+                segment['file'], segment['matrix'], segment['ids'], segment['ref_doc_ids'],
+                segment['alive'], lists=segment['lists']
+            )
+        if ids:
+            self._append_segment(
+                None, matrix, ids, ref_doc_ids, np.ones(len(ids), dtype=bool),
+                lists=np.concatenate(lists) if lists else None
+            )
+        logs.log.info(
+            f"Compacted {len(merge)} of {len(merge) + len(kept)} vector segments into one of {len(ids):,} rows"
+        )
+
+    def build_ann_index(self, n_lists: Optional[int] = None, seed: int = 0) -> None:
+        """Train the IVF index on a sample of live rows and assign every row to a list"""
+        with self._lock:
+            n = self.num_vectors
+            if n == 0:
+                return
+            n_lists = n_lists or IVFIndex.default_n_lists(n)
+            rng = np.random.default_rng(seed)
+
+            # Sample live rows across segments without materializing the whole matrix
+            live = [np.flatnonzero(segment['alive']) for segment in self._segments]
+            offsets = np.cumsum([0] + [len(rows) for rows in live])
+            picks = np.sort(rng.choice(n, size=min(n, n_lists * 64), replace=False))
+            sample = np.vstack([
+                np.asarray(segment['matrix'][rows[picks[(picks >= lo) & (picks < hi)] - lo]], dtype=np.float32)
+                for segment, rows, lo, hi in zip(self._segments, live, offsets[:-1], offsets[1:])
+            ])
+
+            self._ivf = IVFIndex.train(sample, n_lists, trained_size=n, seed=seed)
+            for seg_idx, segment in enumerate(self._segments):
+                segment['lists'] = self._ivf.assign(segment['matrix'])
+                segment['offsets'] = self._list_offsets(segment['lists'])
+                if segment['offsets'] is None:
+                    # The new lists split the file's rows; the next persist rewrites them grouped
+                    self._group_rows(seg_idx)
+
+    def _list_offsets(self, lists: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Row offsets of each IVF list, or None unless the rows are grouped (sorted) by list"""
+        if lists is None or self._ivf is None or np.any(lists[1:] < lists[:-1]):
+            return None
+        return np.searchsorted(lists, np.arange(self._ivf.n_lists + 1)).astype(np.int64)
+
+    def _group_rows(self, seg_idx: int) -> None:
+        """Reorder a segment's rows by IVF list into a new in-memory segment (lock held).
+
+        A persisted segment's file becomes obsolete; the next persist writes the
+        grouped rows. The old dict is left untouched for queries that snapshot it.
+        """
+        segment = self._segments[seg_idx]
+        order = np.argsort(segment['lists'], kind='stable')
+        if segment['file'] is not None:
+            self._obsolete_files.append(segment['file'])
+        grouped = {
+            'file': None,
+            'matrix': np.asarray(segment['matrix'])[order],
+            'ids': [segment['ids'][row] for row in order],
+            'ref_doc_ids': [segment['ref_doc_ids'][row] for row in order],
+            'alive': segment['alive'][order],
+            'lists': segment['lists'][order],
+            'offsets': None
+        }
+        self._segments[seg_idx] = grouped
+        for row, (node_id, alive) in enumerate(zip(grouped['ids'], grouped['alive'])):
+            if alive:
+                self._locations[node_id] = (seg_idx, row)